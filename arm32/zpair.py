@@ -14,15 +14,30 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Reads through arm64/pagereader.py: copy it next to this script, or run
+# this one from a checkout.
+
+import os
+import sys
 
 import idaapi
 import idc
 
+try:
+    import pagereader
+except ImportError:
+    # run from a checkout: the reader lives with the arm64 scripts
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "arm64"))
+    import pagereader
+
 DISTANCE = 4
 
 CODE = 2
 DATA = 3
 
+reader = pagereader.ida_reader()
+
 def get_segments_of_type(attr):
     segs = []
     seg = FirstSeg()
@@ -40,12 +55,12 @@ def doit(seg_start, low, high):
         for (startea, endea) in Chunks(funcea):
             for head in Heads(startea, endea):
                 #print functionName, ":", hex(head), ":", GetDisasm(head)
-                i1 = Dword(head)
+                i1 = reader.dword(head)
                 if (i1 & 0x8000FBF0) == 0xF240:
                     reg = (i1 >> 24) & 0xF
                     tail = head + 4
                     while tail <= head + 4 + DISTANCE:
-                        i2 = Dword(tail)
+                        i2 = reader.dword(tail)
                         if (i2 & 0x8000FBF0) == 0xF2C0 and (i2 >> 24) & 0xF == reg:
                             lo = i1 & 0xFFFF
                             hi = (i1 >> 16) & 0xFFFF
@@ -71,3 +86,4 @@ def doit(seg_start, low, high):
 code = get_segments_of_type(CODE)
 if len(code) > 0:
     doit(code[0], GetLongPrm(INF_LOW_OFF), GetLongPrm(INF_HIGH_OFF))
+    print "reader: %s" % reader.stats()
@@ -16,10 +16,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # based on Rolf Rolles x86 deobfuscator http://www.msreverseengineering.com
+#
+# Install by copying this file into IDA's plugins directory together with
+# the modules it imports from this directory: simpcache.py, simpcore.py,
+# simpscan.py, a64bitmask.py and pagereader.py.  NumPy is optional: without
+# it segments are not indexed and every instruction is decoded on its own.
+
+import hashlib
+import threading
+import traceback
+from timeit import default_timer as clock
 
 import idaapi
 import idc
 
+import pagereader
+from simpcache import SeqCache, TargetBitmap, SegMap, TextCache, ValueIndex, NOSEQ, pack_chains, unpack_chains
+from simpcache import pack_pairs, unpack_pairs
+import simpcore
+import simpscan
+
 ARM64_MOVE_I = idaapi.ARM_mov
 
 def dump_cmd(cmd):
@@ -50,157 +66,631 @@ def dump_op(op):
 	print "specflag3 = %lx" % op.specflag3
 	print "specflag4 = %lx" % op.specflag4
 
-def HighestSetBit(N, imm):
-	i = N - 1
-	while i >= 0:
-		if imm & (1 << i):
-			return i
-		i -= 1
-	return -1
-
-def ZeroExtendOnes(M, N):				# zero extend M ones to N width
-	return (1 << M) - 1
-
-def RORZeroExtendOnes(M, N, R):
-	val = ZeroExtendOnes(M, N)
-	return ((val >> R) & ((1 << (N - R)) - 1)) | ((val & ((1 << R) - 1)) << (N - R))
-
-def Replicate(val, bits):
-	ret = val
-	shift = bits
-	while shift < 64:				# XXX actually, it is either 32 or 64
-		ret |= (val << shift)
-		shift += bits
-	return ret
-
-def DecodeBitMasks(immN, imms, immr, immediate):
-	len = HighestSetBit(7, (immN << 6) | (~imms & 0x3F))
-	if len < 1:
-		return None
-	levels = ZeroExtendOnes(len, 6)
-	if immediate and (imms & levels) == levels:
-		return None
-	S = imms & levels
-	R = immr & levels
-	esize = 1 << len
-	return Replicate(RORZeroExtendOnes(S + 1, esize, R), esize)
-
-def DecodeMov(opcode, total, first):
-	# opc
-	o = (opcode >> 29) & 3
-	# constant
-	k = (opcode >> 23) & 0x3F
-
-	if k == 0x24 and o == 1:			# MOV (bitmask imm) <=> ORR (immediate)
-		# sf
-		s = (opcode >> 31) & 1
-		# N
-		N = (opcode >> 22) & 1
-		if s == 0 and N != 0:
-			return None
-		# rn
-		rn = (opcode >> 5) & 0x1F
-		if rn == 31:
-			imms = (opcode >> 10) & 0x3F
-			immr = (opcode >> 16) & 0x3F
-			return DecodeBitMasks(N, imms, immr, True)
-	elif k == 0x25:					# MOVN/MOVZ/MOVK
-		# sf
-		s = (opcode >> 31) & 1
-		# hw
-		h = (opcode >> 21) & 3
-		# imm16
-		i = (opcode >> 5) & 0xFFFF
-		if s == 0 and h > 1:
-			return None
-		h *= 16
-		i <<= h
-		if o == 0:				# MOVN
-			return ~i
-		elif o == 2:				# MOVZ
-			return i
-		elif o == 3 and not first:		# MOVK
-			return (total & ~(0xFFFF << h)) | i
-	elif (k | 1) == 0x23 and not first:		# ADD (immediate)
-		# shift
-		h = (opcode >> 22) & 3
-		if h > 1:
-			return None
-		# rn
-		rd = opcode & 0x1F
-		rn = (opcode >> 5) & 0x1F
-		if rd != rn:
-			return None
-		# imm12
-		i = (opcode >> 10) & 0xFFF
-		h *= 12
-		i <<= h
-		if o & 2:				# SUB
-			return total - i
-		else:					# ADD
-			return total + i
-
-	return None
-
-def check_mov_sequence(ea):
-	oldea = ea
-	reg = -1
-	total = 0
-	is64 = False
-	while idaapi.getseg(ea).use64():
-		d = idaapi.get_long(ea)
-		# reg
-		r = d & 0x1F
-		if reg >= 0 and reg != r:
-			break
-		newval = DecodeMov(d, total, reg < 0)
-		if newval is None:
-			break
-		if reg >= 0 and idaapi.get_first_fcref_to(ea) != idaapi.BADADDR:
-			break
-		if (d >> 31) & 1:
-			is64 = True
-		total = newval
-		reg = r
-		ea += 4
-	return ea - oldea, reg, is64, total
+segmap = SegMap()
+reader = pagereader.ida_reader()
+
+def refresh_segments():
+	segs = []
+	for i in range(idaapi.get_segm_qty()):
+		seg = idaapi.getnseg(i)
+		segs.append((seg.startEA, seg.endEA, seg.use64()))
+	segmap.load(segs)
+
+def is_target(ea):
+	return idaapi.get_first_fcref_to(ea) != idaapi.BADADDR
+
+def is_target_without(ea, frm):
+	"""is_target(ea) once the cref from frm is gone."""
+	x = idaapi.get_first_fcref_to(ea)
+	while x != idaapi.BADADDR:
+		if x != frm:
+			return True
+		x = idaapi.get_next_fcref_to(ea, x)
+	return False
+
+def ref_bits(start, end):
+	"""
+	TargetBitmap bits of [start, end) from one pass over the flags, with
+	an xref lookup only for the words that have FF_REF set.
+	"""
+	n = (end - start) >> 2
+	bits = bytearray((n + 7) >> 3)
+	for w in xrange(n):
+		ea = start + 4 * w
+		if idaapi.hasRef(idaapi.getFlags(ea)) and is_target(ea):
+			bits[w >> 3] |= 1 << (w & 7)
+	return bits
+
+def check_mov_sequence(ea, is_target=is_target):
+	return simpcore.mov_sequence(ea, reader.dword, segmap.use64, is_target)
 
 def is_my_mov(cmd):
 	if cmd.itype == ARM64_MOVE_I and cmd.flags == idaapi.INSN_MACRO and cmd.size > 4:
 		return True
 	return False
 
-def check_ubfm_shift(ea):
-	if idaapi.getseg(ea).use64():
-		opcode = idaapi.get_long(ea)
-		# opc
-		o = (opcode >> 29) & 3
-		# constant
-		k = (opcode >> 23) & 0x3F
-		if (o & 1) == 0 and k == 0x26:
-			# sf
-			s = (opcode >> 31) & 1
-			# N
-			N = (opcode >> 22) & 1
-			if s == N:
-				# imm
-				imms = (opcode >> 10) & 0x3F
-				immr = (opcode >> 16) & 0x3F
-				mask = 0x1F | ((s & N) << 5)
-				if imms == mask:
-					return idaapi.ARM_lsr if o else idaapi.ARM_asr, opcode, s, immr
-				elif immr == imms + 1:
-					return idaapi.ARM_lsl if o else idaapi.ARM_null, opcode, s, mask - imms
+SHIFT_INSN = {
+	simpcore.SHIFT_NONE: idaapi.ARM_null,
+	simpcore.SHIFT_LSL: idaapi.ARM_lsl,
+	simpcore.SHIFT_LSR: idaapi.ARM_lsr,
+	simpcore.SHIFT_ASR: idaapi.ARM_asr,
+}
+
+def check_ubfm_shift(ea, opcode=None):
+	if segmap.use64(ea):
+		if opcode is None:
+			opcode = reader.dword(ea)
+		kind, s, shift = simpcore.decode_ubfm_shift(opcode)
+		if kind != simpcore.SHIFT_NONE:
+			return SHIFT_INSN[kind], opcode, s, shift
 	return idaapi.ARM_null, 0, 0, 0
 
+# mnemonics custom_out writes itself, OutMnem would append the condition
+SIMP_MNEM = {
+	idaapi.ARM_lsl: "LSL",
+	idaapi.ARM_lsr: "LSR",
+	idaapi.ARM_asr: "ASR",
+}
+
+def is_simplified(cmd):
+	"""A decoding made by simpA64Hook, other than an ADRP pair."""
+	if cmd.itype == ARM64_MOVE_I:
+		return cmd.flags == idaapi.INSN_MACRO
+	return cmd.itype in SIMP_MNEM and cmd.segpref == 14 and cmd.Op3.type == idaapi.o_imm
+
+def simplified_mnem(cmd):
+	if cmd.itype == ARM64_MOVE_I:
+		return "MOVE" if cmd.size > 4 else "MOV"
+	return SIMP_MNEM[cmd.itype]
+
+def operand_fields(cmd):
+	return tuple((op.type, op.dtyp, op.reg, op.value) for op in (cmd.Op1, cmd.Op2, cmd.Op3) if op.type != idaapi.o_void)
+
+def format_operand(op):
+	qword = op.dtyp == idaapi.dt_qword
+	if op.type == idaapi.o_reg:
+		return idaapi.COLSTR(idaapi.get_reg_name(op.reg, 8 if qword else 4), idaapi.SCOLOR_REG)
+	v = op.value & (0xFFFFFFFFFFFFFFFF if qword else 0xFFFFFFFF)
+	return idaapi.COLSTR("#", idaapi.SCOLOR_SYMBOL) + idaapi.COLSTR("%d" % v if v < 10 else "0x%X" % v, idaapi.SCOLOR_NUMBER)
+
+PAGE_DREF = {
+	simpcore.PAGE_ADD: idaapi.dr_O,
+	simpcore.PAGE_LOAD: idaapi.dr_R,
+	simpcore.PAGE_STORE: idaapi.dr_W,
+}
+
+def add_page_xrefs(index):
+	for ea, (target, kind, adrp) in index:
+		idaapi.add_dref(ea, target, PAGE_DREF[kind])
+
+def del_page_xrefs(pairs):
+	for ea, target in pairs:
+		idaapi.del_dref(ea, target)
+
+def requeue(eas):
+	# their decoding changed, let the autoanalysis redo them
+	for ea in eas:
+		idaapi.auto_mark_range(ea, ea + 4, idaapi.AU_USED)
+
+# counters kept by simpA64Hook
+STAT_CALLS = 0
+STAT_MOV = 1
+STAT_UBFM = 2
+STAT_REJECT = 3
+STAT_PAGE = 4
+STAT_SLOTS = 5
+
+# quiet time after a segment change before the index is rebuilt, in ms
+BUILD_DELAY = 500
+
+class simpA64IDBHook(idaapi.IDB_Hooks):
+	def __init__(self, owner):
+		idaapi.IDB_Hooks.__init__(self)
+		self.owner = owner
+
+	def byte_patched(self, ea):
+		reader.invalidate(ea, 1)
+		self.owner.patched(ea)
+		return 0
+
+	def segm_added(self, s):
+		self.owner.reset()
+		return 0
+
+	def segm_deleted(self, startEA):
+		self.owner.reset()
+		return 0
+
+	def segm_start_changed(self, s):
+		self.owner.reset()
+		return 0
+
+	def segm_end_changed(self, s):
+		self.owner.reset()
+		return 0
+
+	def segm_moved(self, _from, to, size):
+		self.owner.reset()
+		return 0
+
 class simpA64Hook(idaapi.IDP_Hooks):
 	def __init__(self):
 		idaapi.IDP_Hooks.__init__(self)
 		self.n = idaapi.netnode("$ A64 Simplifier",0,1)
+		self.cache = SeqCache()
+		self.scanned = set()
+		self.targets = TargetBitmap(is_target)
+		self.idb = simpA64IDBHook(self)
+		# start -> PairIndex of a segment, its xrefs are in the database
+		self.pages = {}
+		# paired segments to pair again, and the ones whose netnode
+		# record lists pairs cut since, see cut_pages()
+		self.stale = set()
+		self.unsaved = set()
+		self.fold_pages = False
+		self.decoding = False
+		# ea -> size of every decoding changed since the last toggle
+		self.folded = {}
+		# background index build, see start_build()
+		self.background = False
+		self.generation = 0
+		self.pending = None
+		self.timer = None
+		# start -> sha1 of the bytes a fully indexed segment was built from
+		self.hashes = {}
+		# segments whose index is in the netnode as it is in the cache
+		self.saved = set()
+		self.stats = [0] * STAT_SLOTS
+		self.elapsed = 0.0
+		self.text = TextCache()
+
+	def reset(self):
+		refresh_segments()
+		reader.clear()
+		self.cache.clear()
+		self.text.clear()
+		self.scanned = set()
+		self.targets.clear()
+		for start in list(self.pages):
+			requeue(self.drop_pages(start))
+		self.hashes = {}
+		self.saved = set()
+		# a build still running answers for the old segments
+		self.generation += 1
+		self.pending = None
+		if self.background or self.fold_pages:
+			self.schedule_build()
+
+	def hook(self):
+		# anything could have changed while we were not listening
+		self.reset()
+		self.idb.hook()
+		ret = idaapi.IDP_Hooks.hook(self)
+		if self.fold_pages:
+			self.build_pages()
+		if self.background:
+			self.start_build()
+		return ret
+
+	def unhook(self):
+		if self.timer is not None:
+			idaapi.unregister_timer(self.timer)
+			self.timer = None
+		self.idb.unhook()
+		return idaapi.IDP_Hooks.unhook(self)
+
+	def add_cref(self, frm, to, type):
+		if (type & idaapi.XREF_MASK) != idaapi.fl_F:
+			self.add_target(to)
+		return 0
+
+	def del_cref(self, frm, to, expand):
+		# the xref is still there, it just does not count
+		self.del_target(to, frm)
+		return 0
+
+	def savebase(self):
+		self.save_index()
+		return 0
+
+	def add_target(self, to):
+		if self.pending is not None:
+			self.pending.append((self.add_target, to))
+		self.targets.add(to)
+		self.rechain(self.cache.crossing(to))
+		# the target starts a new block, which ends the chains tracked across it
+		for a in self.cache.spanning(to, to):
+			self.cache.untrack(a)
+			self.dirty(a)
+		# and the ADRPs paired across it
+		self.cut_pages(to, to)
+
+	def del_target(self, to, frm=idaapi.BADADDR):
+		if self.pending is not None:
+			self.pending.append((self.del_target, to))
+		if is_target_without(to, frm):
+			return
+		self.targets.remove(to)
+		self.cache.invalidate(to, to + 4)
+		self.dirty(to)
+		# an ADRP before it may pair past it now
+		self.repair(to)
+
+	def patched(self, ea):
+		if self.pending is not None:
+			self.pending.append((self.patched, ea))
+		self.cache.invalidate(ea, ea + 1)
+		self.dirty(ea)
+		self.cut_pages(ea, ea + 1)
+		self.repair(ea)
+
+	def rechain(self, eas):
+		# recompute in place, so the cache keeps covering the whole segment
+		for a in eas:
+			self.cache.replace(a, check_mov_sequence(a, self.targets.test))
+			# the saved index is now out of date
+			seg = segmap.segment(a)
+			if seg:
+				self.saved.discard(seg[0])
+
+	def dirty(self, ea):
+		# the cached index of this segment now has holes, do not persist it
+		seg = segmap.segment(ea)
+		if seg:
+			self.hashes.pop(seg[0], None)
+
+	def load_index(self, start, end, digest, blob):
+		"""Fill the cache from a saved index if the segment still hashes to digest."""
+		if not blob:
+			return False
+		try:
+			stored, chains, tracked = unpack_chains(start, blob)
+		except ValueError:
+			return False
+		if stored != digest:
+			return False
+		self.cache.fill(start, end, chains, tracked)
+		self.hashes[start] = digest
+		self.saved.add(start)
+		return True
+
+	def save_index(self):
+		for start in sorted(self.scanned):
+			digest = self.hashes.get(start)
+			if digest is None:
+				self.n.delblob(start, 'C')
+				self.saved.discard(start)
+				continue
+			if start in self.saved:
+				continue
+			seg = segmap.segment(start)
+			if not seg:
+				continue
+			chains = sorted((ea, r) for ea, r in self.cache.seqs.items() if start <= ea < seg[1])
+			tracked = sorted((ea, t) for ea, t in self.cache.tracked.items() if start <= ea < seg[1])
+			self.n.setblob(pack_chains(start, digest, chains, tracked), start, 'C')
+			self.saved.add(start)
+		for start in sorted(self.unsaved):
+			self.save_pages(start)
+
+	def start_build(self):
+		"""Index every 64-bit segment on a worker thread, from a snapshot taken here."""
+		snaps = []
+		for start, end, is64 in zip(segmap.starts, segmap.ends, segmap.is64):
+			if is64 and start not in self.scanned:
+				data = idaapi.get_many_bytes(start, end - start)
+				if data:
+					self.scanned.add(start)
+					snaps.append((start, end, data, self.n.getblob(start, 'C')))
+		if not snaps:
+			return
+		# events seen until the switch are replayed on top of the index
+		self.pending = []
+		print "simpa64: indexing %d segments in the background" % len(snaps)
+		t = threading.Thread(target=self.build, args=(self.generation, snaps))
+		t.daemon = True
+		t.start()
+
+	def schedule_build(self):
+		"""start_build() and build_pages() once the segments have not changed for BUILD_DELAY ms."""
+		# a loader adds them in a burst, each one resets the index
+		if self.timer is not None:
+			idaapi.unregister_timer(self.timer)
+		self.timer = idaapi.register_timer(BUILD_DELAY, self.timed_build)
+
+	def timed_build(self):
+		self.timer = None
+		if self.fold_pages:
+			self.build_pages()
+		if self.background and self.pending is None:
+			self.start_build()
+		return -1
+
+	def build(self, generation, snaps):
+		# worker thread: no IDA calls until execute_sync
+		t = clock()
+		try:
+			out = self.build_segments(snaps)
+		except Exception:
+			# switch() still has to let go of the pending events
+			out = traceback.format_exc()
+		elapsed = clock() - t
+		idaapi.execute_sync(lambda: self.switch(generation, out, elapsed), idaapi.MFF_WRITE)
+
+	def build_segments(self, snaps):
+		out = []
+		for start, end, data, blob in snaps:
+			digest = hashlib.sha1(data).digest()
+			# a guess from the segment's own branches, switch() has the database
+			bits = simpscan.branch_targets(data)[0]
+			maybe = []
+			unknown = []
+			def test(ea, start=start, bits=bits, maybe=maybe, unknown=unknown):
+				# a set bit ends the chain for now and a clear one does not,
+				# switch() asks the database about both
+				w = (ea - start) >> 2
+				if bits[w >> 3] & (1 << (w & 7)):
+					maybe.append(ea)
+					return True
+				unknown.append(ea)
+				return False
+			chains = None
+			if blob:
+				try:
+					stored, chains, tracked = unpack_chains(start, blob)
+				except ValueError:
+					pass
+				else:
+					if stored != digest:
+						chains = None
+			saved = chains is not None
+			if not saved:
+				chains = simpscan.scan_chains(start, data, test)
+				tracked = simpscan.track_chains(start, data, bits)
+			out.append((start, end, digest, saved, bits, chains, tracked, maybe, unknown, data))
+		return out
+
+	def switch(self, generation, out, elapsed):
+		if generation != self.generation:
+			return 0
+		if not isinstance(out, list):
+			self.pending = None
+			print "simpa64: background indexing failed, decoding instructions one by one\n%s" % out.rstrip()
+			return 0
+		count = 0
+		for start, end, digest, saved, bits, chains, tracked, maybe, unknown, data in out:
+			if not saved:
+				self.load_targets(start, end)
+				if self.targets.segs[start][1] != bits:
+					tracked = self.track(start, data)
+			self.cache.fill(start, end, chains, tracked)
+			self.hashes[start] = digest
+			count += len(chains)
+			if saved:
+				# the saved index already knew the database's targets
+				self.saved.add(start)
+				continue
+			for ea in maybe:
+				if not self.targets.test(ea):
+					self.rechain(self.cache.ending(ea) + [ea - 4])
+			for ea in unknown:
+				if self.targets.test(ea):
+					self.rechain(self.cache.crossing(ea))
+		pending, self.pending = self.pending, None
+		for f, ea in pending:
+			f(ea)
+		print "simpa64: switched to the index, %d chains in %d segments, built in %.2fs" % (count, len(out), elapsed)
+		return 1
+
+	def scan(self, ea):
+		# decode the whole segment once, then answer from the cache
+		if self.background:
+			# that is the worker's job, never the UI thread's
+			return None
+		return self.index(ea)
+
+	def index(self, ea):
+		"""Index the segment holding ea on this thread, unless it already is."""
+		if self.pending is not None:
+			return None
+		seg = segmap.segment(ea)
+		if not seg or not seg[2] or seg[0] in self.scanned:
+			return None
+		start, end = seg[:2]
+		self.scanned.add(start)
+		data = idaapi.get_many_bytes(start, end - start)
+		if not data:
+			return None
+		digest = hashlib.sha1(data).digest()
+		if not self.load_index(start, end, digest, self.n.getblob(start, 'C')):
+			if simpscan.numpy is None:
+				return None
+			self.load_targets(start, end)
+			chains = simpscan.scan_chains(start, data, self.targets.test)
+			tracked = self.track(start, data)
+			self.cache.fill(start, end, chains, tracked)
+			self.hashes[start] = digest
+		return self.cache.seqs.get(ea, NOSEQ)
+
+	def tracked_at(self, ea):
+		"""The interleaved chain whose last word is at ea, else None."""
+		self.scan(ea)
+		t = self.cache.tracked.get(ea)
+		return t[1] if t is not None else None
+
+	def load_targets(self, start, end):
+		# code xref targets of a segment, read once for all the scanners,
+		# the cref events keep them current
+		if start not in self.targets.segs:
+			self.targets.add_segment(start, end, ref_bits(start, end))
+
+	def track(self, start, data):
+		"""track_chains, ended at the segment's targets."""
+		return simpscan.track_chains(start, data, self.targets.segs[start][1])
+
+	def pairs(self, start, data):
+		"""scan_pages, the same way."""
+		return simpscan.scan_pages(start, data, self.targets.segs[start][1])
+
+	def fold_ranges(self):
+		"""ea -> size of everything the hook folds in the 64-bit segments."""
+		out = {}
+		for start, end, is64 in zip(segmap.starts, segmap.ends, segmap.is64):
+			if not is64:
+				continue
+			data = idaapi.get_many_bytes(start, end - start)
+			if not data:
+				continue
+			self.load_targets(start, end)
+			for ea, r in simpscan.scan_chains(start, data, self.targets.test):
+				out[ea] = r[0]
+			for ea, t in self.track(start, data):
+				out.setdefault(ea, 4)
+			for ea in simpscan.shift_aliases(start, data):
+				out.setdefault(ea, 4)
+			for ea, p in self.pages.get(start, ()):
+				out.setdefault(ea, 4)
+		return out
+
+	def page_index(self, ea):
+		"""ADRP pairs of the segment holding ea, once build_pages() made them."""
+		seg = segmap.segment(ea)
+		return self.pages.get(seg[0]) if seg else None
+
+	def build_pages(self):
+		"""
+		Pair the 64-bit segments not paired yet or gone stale, and bring
+		their xrefs in line.  Never from ana, which only looks pairs up.
+		"""
+		changed = set()
+		for start, end, is64 in zip(segmap.starts, segmap.ends, segmap.is64):
+			if not is64 or (start in self.pages and start not in self.stale):
+				continue
+			self.stale.discard(start)
+			data = idaapi.get_many_bytes(start, end - start)
+			if data:
+				self.load_targets(start, end)
+				index = self.pairs(start, data)
+			else:
+				index = simpscan.PairIndex()
+			changed |= self.set_pages(start, index)
+		requeue(sorted(changed))
+
+	def stored_pages(self, start):
+		"""(ea, target) of the page xrefs the database has from the segment at start."""
+		index = self.pages.get(start)
+		if index is not None:
+			return [(ea, p[0]) for ea, p in index]
+		blob = self.n.getblob(start, 'P')
+		if blob:
+			try:
+				return unpack_pairs(start, blob)
+			except ValueError:
+				pass
+		return []
+
+	def set_pages(self, start, index):
+		"""
+		Make index the pairs of the segment at start, adding and deleting
+		only the xrefs that differ.  Returns the consumers that changed.
+		"""
+		old = set(self.stored_pages(start))
+		new = set((ea, p[0]) for ea, p in index)
+		del_page_xrefs(old - new)
+		add_page_xrefs((ea, p) for ea, p in index if (ea, p[0]) not in old)
+		self.pages[start] = index
+		self.save_pages(start)
+		return set(ea for ea, target in old ^ new)
+
+	def save_pages(self, start):
+		self.n.setblob(pack_pairs(start, self.stored_pages(start)), start, 'P')
+		self.unsaved.discard(start)
+
+	def drop_pages(self, start):
+		"""Forget the pairs of the segment at start and delete their xrefs, returns the consumers."""
+		old = self.stored_pages(start)
+		del_page_xrefs(old)
+		self.pages.pop(start, None)
+		self.stale.discard(start)
+		self.unsaved.discard(start)
+		self.n.delblob(start, 'P')
+		return [ea for ea, target in old]
+
+	def drop_all_pages(self):
+		"""drop_pages() of every segment, also the ones paired in an earlier session."""
+		eas = []
+		for i in range(idaapi.get_segm_qty()):
+			eas += self.drop_pages(idaapi.getnseg(i).startEA)
+		return eas
+
+	def cut_pages(self, start, end):
+		# the pairs a change at [start, end) breaks go right away
+		seg = segmap.segment(start)
+		index = self.pages.get(seg[0]) if seg else None
+		if index:
+			gone = index.cut(start, end)
+			if gone:
+				del_page_xrefs((ea, p[0]) for ea, p in gone)
+				self.unsaved.add(seg[0])
+				requeue(ea for ea, p in gone)
+
+	def repair(self, ea):
+		# new pairs wait until the changes stop
+		seg = segmap.segment(ea)
+		if seg and seg[0] in self.pages:
+			self.stale.add(seg[0])
+			self.schedule_build()
+
+	def operand_text(self, cmd):
+		"""Formatted operands of a simplified cmd, kept until its decoding changes."""
+		key = cmd.ea, cmd.itype
+		fields = operand_fields(cmd)
+		text = self.text.get(key, fields)
+		if text is None:
+			ops = (cmd.Op1, cmd.Op2, cmd.Op3)[:len(fields)]
+			text = [format_operand(op) for op in ops]
+			self.text.put(key, fields, text)
+		return text
+
+	def summary(self):
+		s = self.stats
+		calls = s[STAT_CALLS] or 1
+		return "%d calls, %d MOV, %d UBFM, %d ADRP pairs, %d rejected, %.3fs (%.1fus/call)" % (s[STAT_CALLS],
+			s[STAT_MOV], s[STAT_UBFM], s[STAT_PAGE], s[STAT_REJECT], self.elapsed, self.elapsed * 1e6 / calls)
 
 	def custom_ana(self):
-		len, reg, is64, imm = check_mov_sequence(idaapi.cmd.ea)
-		if len > 4:
+		if self.decoding:
+			return False
+		self.stats[STAT_CALLS] += 1
+		t = clock()
+		ret = self.simplify()
+		self.elapsed += clock() - t
+		if ret:
+			self.folded[idaapi.cmd.ea] = idaapi.cmd.size
+		return ret
+
+	def simplify(self):
+		ea = idaapi.cmd.ea
+		opcode = reader.dword(ea)
+		cls = simpcore.OPCLASS[opcode >> 23]
+		tracked = None
+		if cls & simpcore.OPC_MOV:
+			r = self.cache.lookup(ea)
+			if r is None:
+				r = self.scan(ea)
+			if r is None:
+				r = check_mov_sequence(ea, self.targets.test)
+				self.cache.store(ea, r)
+		elif cls & simpcore.OPC_MOVK and self.tracked_at(ea):
+			# last word of a chain interleaved with other code, this word only
+			r = tracked = self.cache.tracked[ea][1]
+		elif cls & simpcore.OPC_PAGEOFF and self.fold_pages and self.fold_page(ea):
+			self.stats[STAT_PAGE] += 1
+			return True
+		else:
+			r = NOSEQ
+		len, reg, is64, imm = r
+		if len > 4 or tracked:
 			#print "0x%x: MOV/MOVK %c%d, #0x%x" % (idaapi.cmd.ea, 'X' if is64 else 'W', reg, imm)
 			#dump_cmd(idaapi.cmd)
 			#dump_op(idaapi.cmd.Op1)
@@ -215,8 +705,12 @@ class simpA64Hook(idaapi.IDP_Hooks):
 			idaapi.cmd.Op2.value = imm
 			idaapi.cmd.flags = idaapi.INSN_MACRO
 			idaapi.cmd.size = len
+			self.stats[STAT_MOV] += 1
 			return True
-		insn, regs, is64, shift = check_ubfm_shift(idaapi.cmd.ea)
+		if cls & simpcore.OPC_SHIFT:
+			insn, regs, is64, shift = check_ubfm_shift(ea, opcode)
+		else:
+			insn = idaapi.ARM_null
 		if insn != idaapi.ARM_null:
 			idaapi.cmd.itype = insn
 			idaapi.cmd.segpref = 14
@@ -230,32 +724,122 @@ class simpA64Hook(idaapi.IDP_Hooks):
 			idaapi.cmd.Op3.dtyp = idaapi.dt_qword if is64 else idaapi.dt_dword
 			idaapi.cmd.Op3.value = shift
 			idaapi.cmd.size = 4
+			self.stats[STAT_UBFM] += 1
 			return True
+		self.stats[STAT_REJECT] += 1
 		return False
 
+	def fold_page(self, ea):
+		# let the processor module decode the consumer, then swap in the target,
+		# build_pages() made the pairs and their xrefs beforehand
+		index = self.page_index(ea)
+		p = index.lookup(ea) if index else None
+		if p is None:
+			return False
+		self.decoding = True
+		try:
+			if not idaapi.decode_insn(ea):
+				return False
+		finally:
+			self.decoding = False
+		target, kind, adrp = p
+		if kind == simpcore.PAGE_ADD:
+			# ADD Xd, Xn, #pageoff -> ADR Xd, target
+			idaapi.cmd.itype = idaapi.ARM_adr
+			idaapi.cmd.Op3.type = idaapi.o_void
+		idaapi.cmd.Op2.type = idaapi.o_mem
+		idaapi.cmd.Op2.addr = target
+		return True
+
 	def custom_mnem(self): # totally optional
 		if is_my_mov(idaapi.cmd):
 			return "MOVE"
 		return None
 
-#	def custom_out(self): # XXX ida would just append .EQ
-#		if is_my_mov(idaapi.cmd):
-#			buf = idaapi.init_output_buffer(1024)
-#			idaapi.OutMnem(16, "")
-#			idaapi.out_one_operand(0)
-#			idaapi.out_symbol(',')
-#			idaapi.OutChar(' ')
-#			idaapi.out_one_operand(1)
-#			idaapi.term_output_buffer()
-#			idaapi.MakeLine(buf)
-#			return True
-#		return False
-
-#	def custom_outop(self, op): # XXX ida would just use Rn
-#		if is_my_mov(idaapi.cmd) and op.type == idaapi.o_reg:
-#			idaapi.out_register("%c%d" % ('X' if op.dtyp == idaapi.dt_qword else 'W', op.reg))
-#			return True
-#		return False
+	def custom_out(self): # OutMnem would append .EQ
+		cmd = idaapi.cmd
+		if not is_simplified(cmd):
+			return False
+		text = self.operand_text(cmd)
+		flags = idaapi.getFlags(cmd.ea)
+		buf = idaapi.init_output_buffer(1024)
+		idaapi.OutLine(idaapi.COLSTR("%-16s" % simplified_mnem(cmd), idaapi.SCOLOR_INSN))
+		for n, s in enumerate(text):
+			if n:
+				idaapi.out_symbol(',')
+				idaapi.OutChar(' ')
+			if idaapi.isDefArg(flags, n):
+				# the user picked a representation, let ida format it
+				idaapi.out_one_operand(n)
+			else:
+				idaapi.OutLine(s)
+		idaapi.term_output_buffer()
+		idaapi.cvar.gl_comm = 1
+		idaapi.MakeLine(buf)
+		return True
+
+	def custom_outop(self, op): # ida would just use Rn
+		if is_simplified(idaapi.cmd) and op.type == idaapi.o_reg:
+			idaapi.OutLine(format_operand(op))
+			return True
+		return False
+
+class ValueChooser(idaapi.Choose2):
+	def __init__(self, title, items):
+		idaapi.Choose2.__init__(self, title, [
+			["Address", 16 | idaapi.Choose2.CHCOL_HEX],
+			["Register", 4],
+			["Value", 18 | idaapi.Choose2.CHCOL_HEX],
+			["Size", 4 | idaapi.Choose2.CHCOL_DEC]])
+		self.items = items
+
+	def OnGetSize(self):
+		return len(self.items)
+
+	def OnGetLine(self, n):
+		ea, (len, reg, is64, imm) = self.items[n]
+		return ["%X" % ea, "%c%d" % ('X' if is64 else 'W', reg), "%X" % ValueIndex.value((len, reg, is64, imm)), "%d" % len]
+
+	def OnSelectLine(self, n):
+		idc.Jump(self.items[n][0])
+
+# hook of the loaded plugin, for the functions below
+active = None
+
+def indexed_hook():
+	if active is None:
+		raise RuntimeError("simpa64 is not running")
+	# a value only counts once its segment is in the cache
+	for start, end, is64 in zip(segmap.starts, segmap.ends, segmap.is64):
+		if is64:
+			active.index(start)
+	return active
+
+def find_value(value):
+	"""Addresses of the folded sequences that load value."""
+	return indexed_hook().cache.values.find(value)
+
+def find_range(lo, hi):
+	"""Sorted (value, ea) of the folded sequences loading a value in [lo, hi]."""
+	return indexed_hook().cache.values.range(lo, hi)
+
+def show_values(lo=0, hi=0xFFFFFFFFFFFFFFFF, title="Folded constants"):
+	hook = indexed_hook()
+	items = [(ea, hook.cache.result(ea)) for v, ea in hook.cache.values.range(lo, hi)]
+	c = ValueChooser(title, items)
+	c.Show()
+	return c
+
+def parse_range(s):
+	""""v" or "lo-hi" -> (lo, hi), empty -> everything."""
+	s = s.strip()
+	if not s:
+		return 0, 0xFFFFFFFFFFFFFFFF
+	if "-" in s[1:]:
+		i = s.index("-", 1)
+		return int(s[:i], 0), int(s[i + 1:], 0)
+	v = int(s, 0)
+	return v, v
 
 class simpa64_t(idaapi.plugin_t):
 	flags = idaapi.PLUGIN_PROC
@@ -263,7 +847,9 @@ class simpa64_t(idaapi.plugin_t):
 	wanted_hotkey = "Alt-Z"
 	help = "Runs transparently"
 	wanted_name = "simpa64"
+	stats_hotkey = "Shift-Alt-Z"
 	hook = None
+	hotkey = None
 	enabled = 1
 
 	def init(self):
@@ -272,27 +858,121 @@ class simpa64_t(idaapi.plugin_t):
 			return idaapi.PLUGIN_SKIP
 
 		self.hook = simpA64Hook()
+		global active
+		active = self.hook
 		flag = self.hook.n.altval(0)
 		if flag:
 			self.enabled = flag - 1
+		self.hook.fold_pages = self.hook.n.altval(1) == 2
+		self.hook.background = self.hook.n.altval(2) == 2
+		# summary saved by the previous session, see term()
+		self.last = self.hook.n.supval(1)
 		print "%s is %sabled" % (self.wanted_name, "en" if self.enabled else "dis")
+		if self.hook.fold_pages:
+			print "%s folds ADRP pairs" % self.wanted_name
 		if self.enabled:
 			self.hook.hook()
+		self.hotkey = idaapi.add_hotkey(self.stats_hotkey, self.dump)
 		return idaapi.PLUGIN_KEEP
 
+	def dump(self):
+		print "%s: %s" % (self.wanted_name, self.hook.summary())
+		print "%s cache: %d hits, %d misses" % (self.wanted_name, self.hook.cache.hits, self.hook.cache.misses)
+		print "%s text: %d hits, %d misses" % (self.wanted_name, self.hook.text.hits, self.hook.text.misses)
+		print "%s reader: %s" % (self.wanted_name, reader.stats())
+		if self.last:
+			print "%s last session: %s" % (self.wanted_name, self.last)
+
+	def toggle_pages(self):
+		hook = self.hook
+		hook.fold_pages = not hook.fold_pages
+		hook.n.altset(1, 2 if hook.fold_pages else 1)
+		print "%s ADRP pair folding %sabled" % (self.wanted_name, "en" if hook.fold_pages else "dis")
+		ranges = {}
+		if hook.fold_pages:
+			if self.enabled:
+				# pair every 64-bit segment now, so the xrefs go in as one batch
+				hook.build_pages()
+			for index in hook.pages.values():
+				for ea, p in index:
+					ranges[ea] = 4
+		else:
+			# reanalysis puts back the xrefs IDA makes itself
+			for ea in hook.drop_all_pages():
+				ranges[ea] = 4
+		print "%s: %d ADRP pairs" % (self.wanted_name, len(ranges))
+		if self.enabled:
+			self.reanalyze(ranges)
+
+	def reanalyze(self, ranges):
+		# redo only the items whose decoding changes, plus the word after each
+		t = clock()
+		count = 0
+		for ea, size in sorted(ranges.items()):
+			if not idaapi.isCode(idaapi.getFlags(ea)):
+				continue
+			idaapi.do_unknown_range(ea, size, idaapi.DOUNK_SIMPLE)
+			idaapi.auto_mark_range(ea, ea + size + 4, idaapi.AU_CODE)
+			count += 1
+		idaapi.autoWait()
+		print "%s: reanalysed %d items in %.2fs" % (self.wanted_name, count, clock() - t)
+
 	def run(self, arg):
+		if arg == 1:
+			self.dump()
+			return
+		if arg == 2:
+			self.toggle_pages()
+			return
+		if arg == 4:
+			s = idc.AskStr("", "Value or range (lo-hi), empty for all")
+			if s is not None:
+				try:
+					lo, hi = parse_range(s)
+				except ValueError:
+					print "%s: bad value %r" % (self.wanted_name, s)
+					return
+				t = clock()
+				c = show_values(lo, hi)
+				print "%s: %d folded constants in %.3fs" % (self.wanted_name, len(c.items), clock() - t)
+			return
+		if arg == 3:
+			hook = self.hook
+			hook.background = not hook.background
+			hook.n.altset(2, 2 if hook.background else 1)
+			print "%s background indexing %sabled" % (self.wanted_name, "en" if hook.background else "dis")
+			if hook.background and self.enabled and hook.pending is None:
+				hook.start_build()
+			return
 		print "%sabling %s" % ("dis" if self.enabled else "en", self.wanted_name)
 		if self.enabled:
+			# the ranges must be known before the hook lets go of them
+			ranges = self.hook.fold_ranges()
 			self.hook.unhook()
+			# the pairs' xrefs go with the hook that made them
+			for ea in self.hook.drop_all_pages():
+				ranges[ea] = 4
 		else:
 			self.hook.hook()
+			ranges = self.hook.fold_ranges()
+		ranges.update(self.hook.folded)
+		self.hook.folded = {}
 		self.enabled = self.enabled ^ 1
 		self.hook.n.altset(0, self.enabled + 1)
+		self.reanalyze(ranges)
 		idc.Refresh()
 
 	def term(self):
+		global active
+		active = None
+		if self.hotkey is not None:
+			idaapi.del_hotkey(self.hotkey)
+			self.hotkey = None
 		if self.hook:
 			self.hook.unhook()
+			self.hook.save_index()
+			if self.hook.stats[STAT_CALLS]:
+				self.hook.n.supset(1, "IDA %s: %s" % (idaapi.get_kernel_version(), self.hook.summary()))
 
 def PLUGIN_ENTRY():
 	return simpa64_t()
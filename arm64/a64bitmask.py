@@ -0,0 +1,113 @@
+#  AArch64 logical immediate tables
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# BITMASK_IMM is indexed by the 13-bit N:immr:imms field, which sits at
+# bits 10-22 of every logical (immediate) instruction, so a decoder only
+# needs ((opcode >> 10) & 0x1FFF).  Entries are the 64-bit immediate or
+# None for reserved encodings.  Run this file directly to check the table
+# against the bit-twiddling decoder below.
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def HighestSetBit(N, imm):
+	i = N - 1
+	while i >= 0:
+		if imm & (1 << i):
+			return i
+		i -= 1
+	return -1
+
+def ZeroExtendOnes(M, N):				# zero extend M ones to N width
+	return (1 << M) - 1
+
+def RORZeroExtendOnes(M, N, R):
+	val = ZeroExtendOnes(M, N)
+	return ((val >> R) & ((1 << (N - R)) - 1)) | ((val & ((1 << R) - 1)) << (N - R))
+
+def Replicate(val, bits):
+	ret = val
+	shift = bits
+	while shift < 64:				# XXX actually, it is either 32 or 64
+		ret |= (val << shift)
+		shift += bits
+	return ret
+
+def DecodeBitMasks(immN, imms, immr, immediate):
+	len = HighestSetBit(7, (immN << 6) | (~imms & 0x3F))
+	if len < 1:
+		return None
+	levels = ZeroExtendOnes(len, 6)
+	if immediate and (imms & levels) == levels:
+		return None
+	S = imms & levels
+	R = immr & levels
+	esize = 1 << len
+	return Replicate(RORZeroExtendOnes(S + 1, esize, R), esize)
+
+def build_tables():
+	table = [None] * 0x2000
+	inverse = {}
+	esize = 2
+	while esize <= 64:
+		emask = (1 << esize) - 1
+		rep = MASK64 // emask			# 0x5555..., 0x1111..., ..., 1
+		N = 1 if esize == 64 else 0
+		sizebits = ~(2 * esize - 1) & 0x3F	# 0, 100000, 110000, ...
+		for S in range(esize - 1):
+			ones = (1 << (S + 1)) - 1
+			imms = sizebits | S
+			for R in range(esize):
+				elt = ((ones >> R) | (ones << (esize - R))) & emask
+				val = elt * rep
+				# immr bits above the element size are ignored
+				for immr in range(R, 64, esize):
+					enc = (N << 12) | (immr << 6) | imms
+					table[enc] = val
+					inverse.setdefault(val, []).append(enc)
+		esize <<= 1
+	for encs in inverse.values():
+		encs.sort()
+	return table, inverse
+
+BITMASK_IMM, BITMASK_ENC = build_tables()
+
+def bitmask_imm(N, imms, immr):
+	return BITMASK_IMM[(N << 12) | (immr << 6) | imms]
+
+def bitmask_encodings(value, is64=True):
+	"""Return the (N, immr, imms) triples whose logical immediate is value."""
+	if is64:
+		encs = BITMASK_ENC.get(value & MASK64, ())
+	else:
+		value &= 0xFFFFFFFF
+		encs = [enc for enc in BITMASK_ENC.get(value | (value << 32), ()) if enc < 0x1000]
+	return [(enc >> 12, (enc >> 6) & 0x3F, enc & 0x3F) for enc in encs]
+
+def check_tables():
+	for enc in range(0x2000):
+		N, immr, imms = enc >> 12, (enc >> 6) & 0x3F, enc & 0x3F
+		ref = DecodeBitMasks(N, imms, immr, True)
+		if BITMASK_IMM[enc] != ref:
+			raise AssertionError("N=%d immr=%d imms=%d: %r != %r" % (N, immr, imms, BITMASK_IMM[enc], ref))
+		if ref is not None and (N, immr, imms) not in bitmask_encodings(ref):
+			raise AssertionError("N=%d immr=%d imms=%d missing from inverse index" % (N, immr, imms))
+	if sum(len(encs) for encs in BITMASK_ENC.values()) != len([v for v in BITMASK_IMM if v is not None]):
+		raise AssertionError("inverse index size mismatch")
+
+if __name__ == "__main__":
+	check_tables()
+	print("%d encodings, %d distinct immediates: OK" % (len(BITMASK_IMM), len(BITMASK_ENC)))
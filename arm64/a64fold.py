@@ -0,0 +1,230 @@
+#  Headless AArch64 constant folder
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Runs the simpa64 MOV chain folding over files without IDA and writes one
+# JSON object per folded constant:
+#
+#   python a64fold.py [-j JOBS] [-o OUT] [--raw BASE[:OFFSET[:SIZE]]] FILE...
+#
+# Code is taken from the instruction sections of 64-bit Mach-O (thin, fat
+# or fileset) and AArch64 ELF files.  Anything else needs --raw.  Without
+# a database, every decoded branch target ends a chain, the way an xref
+# does in IDA.  Chains interleaved with other code are reported at their
+# last word, with "start" holding the address of their first.
+
+import argparse
+import json
+import mmap
+import multiprocessing
+import struct
+import sys
+
+import simpscan
+
+CPU_TYPE_ARM64 = 0x0100000C
+LC_SEGMENT_64 = 0x19
+LC_FILESET_ENTRY = 0x80000035
+S_ATTR_PURE_INSTRUCTIONS = 0x80000000
+S_ATTR_SOME_INSTRUCTIONS = 0x400
+VM_PROT_EXECUTE = 4
+
+EM_AARCH64 = 183
+SHT_NOBITS = 8
+SHF_EXECINSTR = 4
+PT_LOAD = 1
+PF_X = 1
+
+def macho_sections(mm, header=0, base=0, seen=None):
+	"""
+	(name, vmaddr, fileoff, size) of the code in the Mach-O at header.
+	base is what its file offsets are relative to: the start of the fat
+	slice, which fileset entries share with their container.
+	"""
+	magic, cputype = struct.unpack_from("<Ii", mm, header)
+	if magic != 0xFEEDFACF or cputype != CPU_TYPE_ARM64:
+		return []
+	ncmds, = struct.unpack_from("<I", mm, header + 16)
+	if seen is None:
+		seen = set()
+	out = []
+	off = header + 32
+	for i in range(ncmds):
+		cmd, cmdsize = struct.unpack_from("<II", mm, off)
+		if cmd == LC_SEGMENT_64:
+			segname, vmaddr, vmsize, fileoff, filesize, maxprot, initprot, nsects, flags = struct.unpack_from("<16sQQQQiiII", mm, off + 8)
+			segname = segname.rstrip(b"\0").decode("ascii", "replace")
+			found = False
+			for j in range(nsects):
+				sectname, _, addr, size, offset, _, _, _, sflags = struct.unpack_from("<16s16sQQIIIII", mm, off + 72 + 80 * j)
+				if sflags & (S_ATTR_PURE_INSTRUCTIONS | S_ATTR_SOME_INSTRUCTIONS) and offset:
+					sectname = sectname.rstrip(b"\0").decode("ascii", "replace")
+					out.append(("%s,%s" % (segname, sectname), addr, base + offset, size))
+					found = True
+			# fileset kernelcaches have executable segments without sections
+			if not found and not nsects and initprot & VM_PROT_EXECUTE and filesize:
+				out.append((segname, vmaddr, base + fileoff, min(vmsize, filesize)))
+		elif cmd == LC_FILESET_ENTRY:
+			vmaddr, fileoff = struct.unpack_from("<QQ", mm, off + 8)
+			if fileoff not in seen:
+				seen.add(fileoff)
+				out.extend(macho_sections(mm, base + fileoff, base, seen))
+		off += cmdsize
+	return out
+
+def fat_slice(mm):
+	"""File offset of the arm64 slice of a fat binary, or None."""
+	magic, nfat = struct.unpack_from(">II", mm, 0)
+	for i in range(nfat):
+		if magic == 0xCAFEBABE:
+			cputype, _, offset = struct.unpack_from(">iiI", mm, 8 + 20 * i)
+		else:
+			cputype, _, offset = struct.unpack_from(">iiQ", mm, 8 + 32 * i)
+		if cputype == CPU_TYPE_ARM64:
+			return offset
+	return None
+
+def elf_sections(mm):
+	if mm[4:6] != b"\x02\x01":				# ELFCLASS64, ELFDATA2LSB
+		return []
+	(e_type, e_machine, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum,
+		e_shentsize, e_shnum, e_shstrndx) = struct.unpack_from("<HHIQQQIHHHHHH", mm, 16)
+	if e_machine != EM_AARCH64:
+		return []
+	out = []
+	if e_shoff and e_shnum:
+		shdrs = [struct.unpack_from("<IIQQQQ", mm, e_shoff + e_shentsize * i) for i in range(e_shnum)]
+		strtab = shdrs[e_shstrndx][4] if e_shstrndx < e_shnum else None
+		for name, type, flags, addr, offset, size in shdrs:
+			if flags & SHF_EXECINSTR and type != SHT_NOBITS and size:
+				if strtab is not None:
+					name = mm[strtab + name:mm.find(b"\0", strtab + name)].decode("ascii", "replace")
+				out.append((name, addr, offset, size))
+	if not out:
+		for i in range(e_phnum):
+			p_type, p_flags, p_offset, p_vaddr, _, p_filesz = struct.unpack_from("<IIQQQQ", mm, e_phoff + e_phentsize * i)
+			if p_type == PT_LOAD and p_flags & PF_X and p_filesz:
+				out.append(("LOAD", p_vaddr, p_offset, p_filesz))
+	return out
+
+def code_sections(mm, raw=None):
+	if raw is not None:
+		base, offset, size = raw
+		if size is None:
+			size = len(mm) - offset
+		return [("raw", base, offset, size)]
+	if len(mm) < 32:
+		return []
+	if mm[:4] == b"\x7fELF":
+		return elf_sections(mm)
+	if mm[:4] in (b"\xca\xfe\xba\xbe", b"\xca\xfe\xba\xbf"):
+		offset = fat_slice(mm)
+		return drop_nested(macho_sections(mm, offset, offset)) if offset is not None else []
+	return drop_nested(macho_sections(mm))
+
+def drop_nested(sections):
+	# a fileset's executable segments contain its entries' __text sections
+	out = []
+	for s in sorted(sections, key=lambda s: (s[2], -s[3])):
+		if out and s[2] + s[3] <= out[-1][2] + out[-1][3]:
+			continue
+		out.append(s)
+	return out
+
+def bitmap_test(start, bits):
+	def test(ea):
+		w = (ea - start) >> 2
+		return bool(bits[w >> 3] & (1 << (w & 7)))
+	return test
+
+def record(path, section, ea, length, reg, is64, value):
+	return {
+		"file": path,
+		"section": section,
+		"ea": "0x%x" % ea,
+		"size": length,
+		"reg": "%c%d" % ("X" if is64 else "W", reg),
+		"value": "0x%x" % (value & (0xFFFFFFFFFFFFFFFF if is64 else 0xFFFFFFFF)),
+	}
+
+def fold_file(job):
+	"""Returns (path, records, error) for one file."""
+	path, raw = job
+	records = []
+	try:
+		with open(path, "rb") as f:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			for name, addr, offset, size in code_sections(mm, raw):
+				size = min(size, len(mm) - offset) & ~3
+				data = mm[offset:offset + size]
+				bits, indirect = simpscan.branch_targets(data)
+				chains = simpscan.scan_chains(addr, data, bitmap_test(addr, bits))
+				for ea, (length, reg, is64, value) in chains:
+					records.append(record(path, name, ea, length, reg, is64, value))
+				# interleaved chains are reported at their last word
+				for ea, (head, (length, reg, is64, value)) in simpscan.track_chains(addr, data, bits):
+					rec = record(path, name, ea, length, reg, is64, value)
+					rec["start"] = "0x%x" % head
+					records.append(rec)
+		finally:
+			mm.close()
+	except (IOError, OSError, ValueError, struct.error) as e:
+		return path, records, str(e)
+	return path, records, None
+
+def parse_raw(s):
+	parts = [int(x, 0) for x in s.split(":")]
+	if len(parts) > 3:
+		raise argparse.ArgumentTypeError("expected BASE[:OFFSET[:SIZE]]")
+	parts += [0, None][len(parts) - 1:]
+	return tuple(parts)
+
+def main():
+	ap = argparse.ArgumentParser(description="Fold AArch64 MOVZ/MOVK/MOVN/ORR/ADD chains into constants")
+	ap.add_argument("files", nargs="+")
+	ap.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count())
+	ap.add_argument("-o", "--output", help="JSON lines output (default: stdout)")
+	ap.add_argument("--raw", type=parse_raw, metavar="BASE[:OFFSET[:SIZE]]", help="treat the files as raw code loaded at BASE")
+	args = ap.parse_args()
+
+	jobs = [(path, args.raw) for path in args.files]
+	if args.jobs > 1 and len(jobs) > 1:
+		pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+		results = pool.imap(fold_file, jobs)
+	else:
+		pool = None
+		results = map(fold_file, jobs)
+
+	out = open(args.output, "w") if args.output else sys.stdout
+	failed = 0
+	try:
+		for path, records, error in results:
+			if error:
+				sys.stderr.write("%s: %s\n" % (path, error))
+				failed += 1
+			for r in records:
+				out.write(json.dumps(r, sort_keys=True) + "\n")
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+		if out is not sys.stdout:
+			out.close()
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,294 @@
+#  AArch64 mov simplifier benchmark
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Runs outside IDA: a stand-in idaapi module serving a synthetic blob is
+# installed before Simp.py is imported.
+#
+#   python bench_simp.py [-n INSNS] [--seed N]
+#   python bench_simp.py --suite [-o results.json]
+#
+# --suite times each decoder on its own over a compiler-like stream and
+# writes the numbers as JSON, so runs can be diffed for regressions.  The
+# bitmask decoding is timed as the hook does it, a BITMASK_IMM lookup; the
+# bit-twiddling DecodeBitMasks it replaced is under "reference".
+
+import argparse
+import json
+import platform
+import random
+import struct
+import sys
+import time
+from timeit import default_timer as clock
+import types
+
+BASE = 0xFFFFFFF007004000
+
+class _Seg(object):
+	def __init__(self, start, end):
+		self.startEA = self.start_ea = start
+		self.endEA = self.end_ea = end
+
+	def use64(self):
+		return True
+
+class _Hooks(object):
+	def __init__(self):
+		pass
+
+	def hook(self):
+		return True
+
+	def unhook(self):
+		return True
+
+class _Choose(object):
+	CHCOL_PLAIN, CHCOL_HEX, CHCOL_DEC = 0, 0x20000, 0x30000
+
+def install_shim(base, data, targets=()):
+	"""Make 'import idaapi' serve data as one 64-bit segment at base."""
+	words = struct.unpack("<%dI" % (len(data) // 4), data)
+	end = base + len(data)
+	targets = set(targets)
+
+	ida = types.ModuleType("idaapi")
+	ida.BADADDR = 0xFFFFFFFFFFFFFFFF
+	ida.ARM_null, ida.ARM_mov, ida.ARM_lsl, ida.ARM_lsr, ida.ARM_asr = range(5)
+	ida.PLFM_ARM = 1
+	ida.PLUGIN_PROC, ida.PLUGIN_SKIP, ida.PLUGIN_KEEP = 0x20, 0, 2
+	ida.INSN_MACRO = 0x10
+	# Simp.py maps the ADRP pair kinds to these at import time
+	ida.dr_O, ida.dr_W, ida.dr_R = 1, 2, 3
+	ida.add_dref = ida.del_dref = lambda *args: True
+	ida.IDP_Hooks = ida.IDB_Hooks = _Hooks
+	ida.plugin_t = object
+	ida.Choose2 = ida.Choose = _Choose
+	# like the SWIG wrappers, hand out a fresh segment object per call
+	ida.getseg = lambda ea: _Seg(base, end) if base <= ea < end else None
+	ida.get_long = ida.get_dword = lambda ea: words[(ea - base) >> 2] if base <= ea < end else 0
+	ida.get_many_bytes = ida.get_bytes = lambda ea, size: data[ea - base:ea - base + size]
+	ida.get_segm_qty = lambda: 1
+	ida.getnseg = lambda n: _Seg(base, end)
+	ida.get_first_fcref_to = lambda ea: 0 if ea in targets else ida.BADADDR
+	sys.modules["idaapi"] = ida
+	sys.modules["idc"] = types.ModuleType("idc")
+	return ida
+
+def movw(op, sf, hw, imm, rd):
+	return op | (sf << 31) | (hw << 21) | ((imm & 0xFFFF) << 5) | rd
+
+def gen_stream(n, seed=0):
+	"""n words: MOVZ/MOVK chains of 1-4 words between random noise."""
+	rnd = random.Random(seed)
+	out = []
+	while len(out) < n:
+		if rnd.random() < 0.1:
+			rd = rnd.randrange(31)
+			out.append(movw(0x52800000, 1, 0, rnd.getrandbits(16), rd))	# MOVZ
+			for hw in range(1, rnd.randrange(1, 5)):
+				out.append(movw(0x72800000, 1, hw, rnd.getrandbits(16), rd))	# MOVK
+		else:
+			out.append(rnd.getrandbits(32))
+	return struct.pack("<%dI" % n, *out[:n])
+
+def orr_imm(sf, enc, rd):
+	N, immr, imms = enc
+	return 0x32000000 | (sf << 31) | (N << 22) | (immr << 16) | (imms << 10) | (31 << 5) | rd
+
+def addsub_imm(sub, sh, imm, rd):
+	return 0x91000000 | (sub << 30) | (sh << 22) | ((imm & 0xFFF) << 10) | (rd << 5) | rd
+
+def shift_imm(kind, sf, amount, rn, rd):
+	"""LSL/LSR/ASR #amount as the UBFM/SBFM they alias."""
+	size = 64 if sf else 32
+	op = (0xD3400000 if sf else 0x53000000) if kind != "asr" else (0x93400000 if sf else 0x13000000)
+	if kind == "lsl":
+		immr, imms = -amount % size, size - 1 - amount
+	else:
+		immr, imms = amount, size - 1
+	return op | (immr << 16) | (imms << 10) | (rn << 5) | rd
+
+def gen_realistic(n, seed=0):
+	"""
+	n words of what a compiler emits around constants: MOVZ/MOVN chains of
+	1-4 words with MOVK and ADD/SUB continuations, ORR (immediate), shift
+	aliases and random noise.  Returns (data, counts per kind).
+	"""
+	from a64bitmask import BITMASK_IMM
+	enc64 = [(i >> 12, (i >> 6) & 0x3F, i & 0x3F) for i, v in enumerate(BITMASK_IMM) if v is not None]
+	enc32 = [e for e in enc64 if not e[0]]
+	rnd = random.Random(seed)
+	counts = dict.fromkeys(["movz", "movn", "movk", "orr", "addsub", "shift", "noise"], 0)
+	out = []
+	while len(out) < n:
+		x = rnd.random()
+		rd = rnd.randrange(31)
+		sf = int(rnd.random() < 0.7)
+		if x < 0.08:
+			kind = "movn" if rnd.random() < 0.2 else "movz"
+			hws = list(range(4 if sf else 2))
+			rnd.shuffle(hws)
+			length = rnd.randrange(1, len(hws) + 1)
+			op = 0x12800000 if kind == "movn" else 0x52800000
+			out.append(movw(op, sf, hws[0], rnd.getrandbits(16), rd))
+			counts[kind] += 1
+			for hw in hws[1:length]:
+				out.append(movw(0x72800000, sf, hw, rnd.getrandbits(16), rd))
+				counts["movk"] += 1
+			if rnd.random() < 0.15:
+				out.append(addsub_imm(int(rnd.random() < 0.3), int(rnd.random() < 0.2), rnd.getrandbits(12), rd))
+				counts["addsub"] += 1
+		elif x < 0.10:
+			out.append(orr_imm(sf, rnd.choice(enc64 if sf else enc32), rd))
+			counts["orr"] += 1
+			if rnd.random() < 0.3:
+				out.append(movw(0x72800000, sf, rnd.randrange(4 if sf else 2), rnd.getrandbits(16), rd))
+				counts["movk"] += 1
+		elif x < 0.13:
+			kind = rnd.choice(["lsl", "lsr", "asr"])
+			amount = rnd.randrange(1, 64 if sf else 32)
+			out.append(shift_imm(kind, sf, amount, rnd.randrange(31), rd))
+			counts["shift"] += 1
+		else:
+			out.append(rnd.getrandbits(32))
+			counts["noise"] += 1
+	return struct.pack("<%dI" % n, *out[:n]), counts
+
+def measure(fn, args, samples=2000, reps=20):
+	"""
+	Throughput over all args, plus per-call latency percentiles from a
+	sample.  Each sampled call is repeated reps times, since time.time is
+	the only clock py2 has on some platforms.
+	"""
+	t = clock()
+	for a in args:
+		fn(a)
+	total = clock() - t
+	sample = args[::max(1, len(args) // samples)]
+	empty = lambda a: None
+	loop = range(reps)
+	overhead = []
+	lat = []
+	for a in sample:
+		t = clock()
+		for i in loop:
+			empty(a)
+		overhead.append(clock() - t)
+		t = clock()
+		for i in loop:
+			fn(a)
+		lat.append(clock() - t)
+	base = sorted(overhead)[len(overhead) // 2]
+	lat = sorted(max(0.0, x - base) / reps for x in lat)
+	return {
+		"calls": len(args),
+		"seconds": total,
+		"per_second": len(args) / total if total else None,
+		"latency_ns": {
+			"mean": total * 1e9 / len(args),
+			"p50": lat[len(lat) // 2] * 1e9,
+			"p99": lat[min(len(lat) - 1, len(lat) * 99 // 100)] * 1e9,
+		},
+	}
+
+def suite(n, seed):
+	data, counts = gen_realistic(n, seed)
+	install_shim(BASE, data)
+	import Simp
+	import simpcore
+	from a64bitmask import BITMASK_IMM, DecodeBitMasks
+	Simp.refresh_segments()
+	words = list(struct.unpack("<%dI" % n, data))
+	eas = list(range(BASE, BASE + len(data), 4))
+	# the ORR (immediate) words, whose bitmask DecodeMov takes from the table
+	orr = [w for w in words if (w >> 23) & 0x3F == 0x24 and (w >> 29) & 3 == 1]
+	masks = [((w >> 22) & 1, (w >> 10) & 0x3F, (w >> 16) & 0x3F) for w in orr]
+
+	results = {
+		"BITMASK_IMM": measure(lambda w: BITMASK_IMM[(w >> 10) & 0x1FFF], orr),
+		"DecodeMov": measure(lambda w: simpcore.DecodeMov(w, 0, True), words),
+		"DecodeMov_orr": measure(lambda w: simpcore.DecodeMov(w, 0, True), orr),
+		"check_mov_sequence": measure(Simp.check_mov_sequence, eas),
+		"check_ubfm_shift": measure(Simp.check_ubfm_shift, eas),
+	}
+	# what the table replaced, no longer on the hook's path
+	reference = {
+		"DecodeBitMasks": measure(lambda m: DecodeBitMasks(m[0], m[1], m[2], True), masks),
+	}
+	return {
+		"python": platform.python_version(),
+		"implementation": platform.python_implementation(),
+		"instructions": n,
+		"seed": seed,
+		"stream": counts,
+		"results": results,
+		"reference": reference,
+	}
+
+def timeit(fn, eas):
+	t = time.time()
+	for ea in eas:
+		fn(ea)
+	return time.time() - t
+
+def main():
+	ap = argparse.ArgumentParser(description="Simp hook cost per instruction")
+	ap.add_argument("-n", type=int, default=1000000, help="instructions in the synthetic blob")
+	ap.add_argument("--seed", type=int, default=0)
+	ap.add_argument("--suite", action="store_true", help="time each decoder, JSON output")
+	ap.add_argument("-o", "--output", help="write the --suite JSON here instead of stdout")
+	args = ap.parse_args()
+
+	if args.suite:
+		report = json.dumps(suite(args.n, args.seed), indent=2, sort_keys=True)
+		if args.output:
+			with open(args.output, "w") as f:
+				f.write(report + "\n")
+		else:
+			print(report)
+		return
+
+	data = gen_stream(args.n, args.seed)
+	install_shim(BASE, data)
+	import Simp
+	import simpcache
+	import simpscan
+	eas = range(BASE, BASE + len(data), 4)
+	Simp.refresh_segments()
+
+	getseg = timeit(lambda ea: sys.modules["idaapi"].getseg(ea).use64(), eas)
+	segmap = timeit(Simp.segmap.use64, eas)
+
+	before = timeit(Simp.check_mov_sequence, eas)
+
+	t = time.time()
+	chains = simpscan.scan_chains(BASE, data, Simp.is_target)
+	cache = simpcache.SeqCache()
+	cache.fill(BASE, BASE + len(data), chains)
+	scan = time.time() - t
+	after = timeit(cache.lookup, eas)
+
+	print("%d instructions, %d chains" % (args.n, len(chains)))
+	print("per-instruction decode: %8.0f ns" % (before * 1e9 / args.n))
+	print("batch scan:             %8.0f ns" % (scan * 1e9 / args.n))
+	print("per-instruction lookup: %8.0f ns" % (after * 1e9 / args.n))
+	print("speedup:                %8.1fx" % (before / (scan + after)))
+	print("getseg(ea).use64():     %8.0f ns" % (getseg * 1e9 / args.n))
+	print("segmap.use64(ea):       %8.0f ns" % (segmap * 1e9 / args.n))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,124 @@
+#  Page-cached byte reader for IDA scripts
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Reads whole pages with one get_bytes and serves words out of them with
+# struct.unpack_from, instead of one database call per Dword.
+
+from collections import OrderedDict
+import struct
+
+try:
+	import idaapi
+except ImportError:
+	idaapi = None
+
+PAGE_SIZE = 0x1000
+MAX_BYTES = 16 << 20
+
+_dword = struct.Struct("<I")
+
+class PageReader(object):
+	"""
+	LRU of page buffers.  read(ea, size) fetches raw bytes (None if they
+	are not all loaded), word(ea) is the per-dword fallback for such pages.
+	"""
+
+	def __init__(self, read, word, page_size=PAGE_SIZE, max_bytes=MAX_BYTES):
+		self.read = read
+		self.word = word
+		self.page_size = page_size
+		self.max_pages = max(1, max_bytes // page_size)
+		self.reads = 0
+		self.calls = 0
+		self.clear()
+
+	def clear(self):
+		self.pages = OrderedDict()
+		self.base = None
+		self.buf = None
+
+	def page(self, base):
+		buf = self.pages.pop(base, False)
+		if buf is False:
+			self.calls += 1
+			buf = self.read(base, self.page_size)
+			if len(self.pages) >= self.max_pages:
+				self.pages.popitem(last=False)
+		self.pages[base] = buf
+		self.base = base
+		self.buf = buf
+		return buf
+
+	def dword(self, ea):
+		self.reads += 1
+		off = ea - self.base if self.base is not None else -1
+		if off < 0 or off > self.page_size - 4:
+			base = ea - ea % self.page_size
+			off = ea - base
+			if off > self.page_size - 4:
+				# straddles two pages
+				data = self.bytes(ea, 4)
+				if data is None:
+					self.calls += 1
+					return self.word(ea)
+				return _dword.unpack(data)[0]
+			self.page(base)
+		if self.buf is None:
+			self.calls += 1
+			return self.word(ea)
+		return _dword.unpack_from(self.buf, off)[0]
+
+	def bytes(self, ea, size):
+		out = []
+		while size > 0:
+			base = ea - ea % self.page_size
+			buf = self.page(base)
+			if buf is None:
+				return None
+			n = min(size, base + self.page_size - ea)
+			out.append(buf[ea - base:ea - base + n])
+			ea += n
+			size -= n
+		return b"".join(out)
+
+	def invalidate(self, ea, size=1):
+		base = ea - ea % self.page_size
+		while base < ea + size:
+			self.pages.pop(base, None)
+			if base == self.base:
+				self.base = self.buf = None
+			base += self.page_size
+
+	def stats(self):
+		return "%d reads, %d API calls, %d saved" % (self.reads, self.calls, self.reads - self.calls)
+
+def ida_reader(**kwargs):
+	read = idaapi.get_bytes if hasattr(idaapi, "get_bytes") else idaapi.get_many_bytes
+	word = idaapi.get_dword if hasattr(idaapi, "get_dword") else idaapi.get_long
+	return PageReader(read, word, **kwargs)
+
+if idaapi is not None:
+	class PatchWatcher(idaapi.IDB_Hooks):
+		"""Drops the pages of a reader whenever a byte is patched."""
+
+		def __init__(self, reader):
+			idaapi.IDB_Hooks.__init__(self)
+			self.reader = reader
+
+		def byte_patched(self, ea, *args):
+			self.reader.invalidate(ea, 1)
+			return 0
@@ -35,9 +35,13 @@
 import idaapi
 import idc
 
+import pagereader
+
 CODE = 2
 DATA = 3
 
+reader = pagereader.ida_reader()
+
 def get_segments_of_type(attr):
 	segs = []
 	seg = FirstSeg()
@@ -52,7 +56,7 @@ def doit(seg_start):
 
 	ea = seg_start
 	while ea < seg_end:
-		d = Dword(ea)
+		d = reader.dword(ea)
 		if (d & 0xFFC003FF) == 0x910003FD:
 			# add x29, sp, #imm
 			delta = (d >> 10) & 0xFFF
@@ -62,7 +66,7 @@ def doit(seg_start):
 				insns = []
 
 				while prev_ea >= seg_start:
-					prev = Dword(prev_ea)
+					prev = reader.dword(prev_ea)
 
 					imm = (prev >> 15) & 0x7F
 					if imm > 63:
@@ -102,4 +106,11 @@ def doit(seg_start):
 
 code = get_segments_of_type(CODE)
 if len(code) > 0:
-	doit(code[0])
+	# doit() reads back words it has patched
+	watcher = pagereader.PatchWatcher(reader)
+	watcher.hook()
+	try:
+		doit(code[0])
+	finally:
+		watcher.unhook()
+	print "reader: %s" % reader.stats()
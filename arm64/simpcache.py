@@ -0,0 +1,412 @@
+#  AArch64 mov simplifier result caches
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+import struct
+import zlib
+
+NOSEQ = (0, -1, False, 0)
+
+CHUNK_SHIFT = 16					# one bitmap per 64K of address space
+CHUNK_MASK = (1 << CHUNK_SHIFT) - 1
+CHUNK_BYTES = 1 << (CHUNK_SHIFT - 5)			# one bit per instruction word
+
+class ValueIndex(object):
+	"""
+	value -> start addresses of the sequences that load it.  Values are
+	kept at register width.  The sorted key list for range queries is
+	only rebuilt when a query finds it stale.
+	"""
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.eas = {}
+		self.keys = None
+
+	def __len__(self):
+		return len(self.eas)
+
+	@staticmethod
+	def value(r):
+		return r[3] & (0xFFFFFFFFFFFFFFFF if r[2] else 0xFFFFFFFF)
+
+	def add(self, ea, r):
+		v = self.value(r)
+		s = self.eas.get(v)
+		if s is None:
+			s = self.eas[v] = set()
+			self.keys = None
+		s.add(ea)
+
+	def remove(self, ea, r):
+		v = self.value(r)
+		s = self.eas.get(v)
+		if s is not None:
+			s.discard(ea)
+			if not s:
+				del self.eas[v]
+				self.keys = None
+
+	def find(self, value):
+		"""Sorted addresses of the sequences loading value."""
+		return sorted(self.eas.get(value, ()))
+
+	def range(self, lo, hi):
+		"""Sorted (value, ea) for every value in [lo, hi]."""
+		if self.keys is None:
+			self.keys = sorted(self.eas)
+		keys = self.keys
+		out = []
+		for i in range(bisect_left(keys, lo), bisect_right(keys, hi)):
+			v = keys[i]
+			out.extend((v, ea) for ea in sorted(self.eas[v]))
+		return out
+
+class SeqCache(object):
+	"""
+	Memoized check_mov_sequence results.
+
+	Sequences longer than one word are kept in a dict, everything else
+	is a set bit in a per-chunk "not a sequence start" bitmap.  Chains
+	interleaved with other code are kept apart, by their last word.
+	"""
+
+	def __init__(self):
+		self.clear()
+		self.hits = 0
+		self.misses = 0
+
+	def clear(self):
+		self.seqs = {}
+		self.noseq = {}
+		self.values = ValueIndex()
+		# at most simpcore.CHAIN_WINDOW words, so crossing() looks back that far
+		self.maxlen = 0
+		# last word -> (first word, result), see simpscan.track_chains
+		self.tracked = {}
+		self.maxspan = 0
+
+	def lookup(self, ea):
+		r = self.seqs.get(ea)
+		if r is not None:
+			self.hits += 1
+			return r
+		bits = self.noseq.get(ea >> CHUNK_SHIFT)
+		if bits is not None and not ea & 3:
+			w = (ea & CHUNK_MASK) >> 2
+			if bits[w >> 3] & (1 << (w & 7)):
+				self.hits += 1
+				return NOSEQ
+		self.misses += 1
+		return None
+
+	def store(self, ea, r):
+		if ea & 3:
+			return
+		if r[0] > 4:
+			self.drop(ea)
+			self.seqs[ea] = r
+			self.values.add(ea, r)
+			if r[0] > self.maxlen:
+				self.maxlen = r[0]
+			return
+		bits = self.noseq.get(ea >> CHUNK_SHIFT)
+		if bits is None:
+			bits = self.noseq[ea >> CHUNK_SHIFT] = bytearray(CHUNK_BYTES)
+		w = (ea & CHUNK_MASK) >> 2
+		bits[w >> 3] |= 1 << (w & 7)
+
+	def drop(self, ea):
+		r = self.seqs.pop(ea, None)
+		if r is not None:
+			self.values.remove(ea, r)
+
+	def result(self, ea):
+		"""The sequence or interleaved chain the value index has at ea."""
+		r = self.seqs.get(ea)
+		if r is None:
+			r = self.tracked[ea][1]
+		return r
+
+	def track(self, ea, head, r):
+		self.untrack(ea)
+		self.tracked[ea] = (head, r)
+		self.values.add(ea, r)
+		if ea - head > self.maxspan:
+			self.maxspan = ea - head
+
+	def untrack(self, ea):
+		t = self.tracked.pop(ea, None)
+		if t is not None:
+			self.values.remove(ea, t[1])
+
+	def spanning(self, start, end):
+		"""Last words of the interleaved chains with a word in [start, end)."""
+		return [a for a in range(start & ~3, end + self.maxspan, 4)
+			if a in self.tracked and self.tracked[a][0] < end]
+
+	def replace(self, ea, r):
+		"""store() that also drops an older sequence at ea."""
+		self.drop(ea)
+		self.store(ea, r)
+
+	def crossing(self, ea):
+		"""Start addresses of the cached sequences that run past ea."""
+		first = max(ea - self.maxlen, 0) & ~3
+		return [a for a in range(first, ea, 4) if a in self.seqs and a + self.seqs[a][0] > ea]
+
+	def ending(self, ea):
+		"""Start addresses of the cached sequences that stop right before ea."""
+		first = max(ea - self.maxlen, 0) & ~3
+		return [a for a in range(first, ea, 4) if a in self.seqs and a + self.seqs[a][0] == ea]
+
+	def fill(self, start, end, chains, tracked=()):
+		"""Seed [start, end) from a batch scan that found every sequence in it."""
+		for ea in [ea for ea in self.seqs if start <= ea < end]:
+			self.drop(ea)
+		for ea in [ea for ea in self.tracked if start <= ea < end]:
+			self.untrack(ea)
+		for ea, (head, r) in tracked:
+			self.track(ea, head, r)
+		ea = start & ~3
+		while ea < end:
+			c = ea >> CHUNK_SHIFT
+			cend = min((c + 1) << CHUNK_SHIFT, end)
+			if ea & CHUNK_MASK == 0 and cend & CHUNK_MASK == 0:
+				self.noseq[c] = bytearray(b"\xff" * CHUNK_BYTES)
+				ea = cend
+				continue
+			bits = self.noseq.get(c)
+			if bits is None:
+				bits = self.noseq[c] = bytearray(CHUNK_BYTES)
+			while ea < cend:
+				w = (ea & CHUNK_MASK) >> 2
+				bits[w >> 3] |= 1 << (w & 7)
+				ea += 4
+		for ea, r in chains:
+			bits = self.noseq[ea >> CHUNK_SHIFT]
+			w = (ea & CHUNK_MASK) >> 2
+			bits[w >> 3] &= ~(1 << (w & 7))
+			self.store(ea, r)
+
+	def invalidate(self, start, end):
+		"""Forget every result that depends on a word in [start, end)."""
+		start &= ~3
+		for ea in self.spanning(start, end):
+			self.untrack(ea)
+		# a result at ea looks at the words up to and including ea + len
+		ea = max(start - self.maxlen, 0)
+		while ea < end:
+			r = self.seqs.get(ea)
+			if r is not None and ea + r[0] >= start:
+				self.drop(ea)
+			ea += 4
+		# a negative result at ea may have looked at ea + 4
+		ea = max(start - 4, 0)
+		while ea < end:
+			bits = self.noseq.get(ea >> CHUNK_SHIFT)
+			if bits is not None:
+				w = (ea & CHUNK_MASK) >> 2
+				bits[w >> 3] &= ~(1 << (w & 7))
+			ea += 4
+
+TEXT_ENTRIES = 4096
+
+class TextCache(object):
+	"""
+	LRU of formatted operand text, keyed by (ea, itype).  An entry also
+	keeps the operand fields it was formatted from, so text for a decoding
+	that changed since is a miss rather than stale.
+	"""
+
+	def __init__(self, size=TEXT_ENTRIES):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self.clear()
+
+	def clear(self):
+		self.items = OrderedDict()
+
+	def get(self, key, fields):
+		e = self.items.pop(key, None)
+		if e is None or e[0] != fields:
+			self.misses += 1
+			return None
+		self.items[key] = e
+		self.hits += 1
+		return e[1]
+
+	def put(self, key, fields, text):
+		if len(self.items) >= self.size:
+			self.items.popitem(last=False)
+		self.items[key] = (fields, text)
+
+# persisted per-segment index: a header, then one array per field
+INDEX_MAGIC = b"A64I"
+# 3: built with the database's xrefs, see TargetBitmap
+# 4: chains split at simpcore.CHAIN_WINDOW words
+INDEX_VERSION = 4
+_index_header = struct.Struct("<4sI20sII")
+
+def pack_chains(start, digest, chains, tracked=()):
+	"""
+	Encode the (ea, (len, reg, is64, value)) chains and the (ea, (head,
+	(4, reg, is64, value))) interleaved chains of the segment at start,
+	whose bytes hash to digest, for netnode blob storage.
+	"""
+	n = len(chains)
+	m = len(tracked)
+	offs = [(ea - start) >> 2 for ea, r in chains]
+	sizes = [r[0] for ea, r in chains]
+	regs = [r[1] | (0x80 if r[2] else 0) for ea, r in chains]
+	values = [r[3] & 0xFFFFFFFFFFFFFFFF for ea, r in chains]
+	offs += [(ea - start) >> 2 for ea, t in tracked]
+	sizes += [(ea - t[0]) >> 2 for ea, t in tracked]
+	regs += [t[1][1] | (0x80 if t[1][2] else 0) for ea, t in tracked]
+	values += [t[1][3] & 0xFFFFFFFFFFFFFFFF for ea, t in tracked]
+	k = n + m
+	body = struct.pack("<%dI%dI%dB%dQ" % (k, k, k, k), *(offs + sizes + regs + values))
+	return _index_header.pack(INDEX_MAGIC, INDEX_VERSION, digest, n, m) + zlib.compress(body)
+
+def unpack_chains(start, blob):
+	"""
+	Inverse of pack_chains: (digest, chains, tracked).  Raises ValueError
+	if blob is not an index of this version.
+	"""
+	if len(blob) < _index_header.size:
+		raise ValueError("short index")
+	magic, version, digest, n, m = _index_header.unpack_from(blob)
+	if magic != INDEX_MAGIC or version != INDEX_VERSION:
+		raise ValueError("not an index")
+	k = n + m
+	try:
+		body = zlib.decompress(blob[_index_header.size:])
+		fields = struct.unpack("<%dI%dI%dB%dQ" % (k, k, k, k), body)
+	except (zlib.error, struct.error):
+		raise ValueError("corrupt index")
+	chains = []
+	tracked = []
+	for i in range(k):
+		ea = start + 4 * fields[i]
+		reg = fields[2 * k + i]
+		r = reg & 0x1F, bool(reg & 0x80), fields[3 * k + i]
+		if i < n:
+			chains.append((ea, (fields[k + i],) + r))
+		else:
+			tracked.append((ea, (ea - 4 * fields[k + i], (4,) + r)))
+	return digest, chains, tracked
+
+# page xrefs the pair folding added, per segment, so they can be taken out
+PAIRS_MAGIC = b"A64P"
+_pairs_header = struct.Struct("<4sI")
+
+def pack_pairs(start, pairs):
+	"""Encode the (ea, target) page xrefs of the segment at start."""
+	n = len(pairs)
+	body = struct.pack("<%dI%dQ" % (n, n), *([(ea - start) >> 2 for ea, t in pairs] + [t for ea, t in pairs]))
+	return _pairs_header.pack(PAIRS_MAGIC, n) + zlib.compress(body)
+
+def unpack_pairs(start, blob):
+	"""Inverse of pack_pairs.  Raises ValueError if blob is not a pair list."""
+	if len(blob) < _pairs_header.size:
+		raise ValueError("short pair list")
+	magic, n = _pairs_header.unpack_from(blob)
+	if magic != PAIRS_MAGIC:
+		raise ValueError("not a pair list")
+	try:
+		fields = struct.unpack("<%dI%dQ" % (n, n), zlib.decompress(blob[_pairs_header.size:]))
+	except (zlib.error, struct.error):
+		raise ValueError("corrupt pair list")
+	return [(start + 4 * fields[i], fields[n + i]) for i in range(n)]
+
+class TargetBitmap(object):
+	"""
+	Per-segment bitmaps of code reference targets, a copy of what the
+	database knows.  A segment's bits are read from its xrefs once, then
+	kept current with add() and remove() from the cref events, so test()
+	is one bit test.  Addresses outside every registered segment go to
+	resolve(ea).
+	"""
+
+	def __init__(self, resolve):
+		self.resolve = resolve
+		self.clear()
+
+	def clear(self):
+		self.starts = []
+		self.segs = {}
+
+	def add_segment(self, start, end, bits):
+		"""bits: bytearray with bit (w & 7) of byte w >> 3 set for word w."""
+		if start not in self.segs:
+			insort(self.starts, start)
+		self.segs[start] = (end, bits)
+
+	def find(self, ea):
+		i = bisect_right(self.starts, ea) - 1
+		if i >= 0:
+			start = self.starts[i]
+			end, bits = self.segs[start]
+			if ea < end:
+				return start, bits
+		return None, None
+
+	def add(self, ea):
+		start, bits = self.find(ea)
+		if bits is not None:
+			w = (ea - start) >> 2
+			bits[w >> 3] |= 1 << (w & 7)
+
+	def remove(self, ea):
+		start, bits = self.find(ea)
+		if bits is not None:
+			w = (ea - start) >> 2
+			bits[w >> 3] &= ~(1 << (w & 7))
+
+	def test(self, ea):
+		start, bits = self.find(ea)
+		if bits is None:
+			return self.resolve(ea)
+		w = (ea - start) >> 2
+		return bool(bits[w >> 3] & (1 << (w & 7)))
+
+class SegMap(object):
+	"""Sorted segment ranges, answering use64(ea) without an IDA call."""
+
+	def __init__(self):
+		self.load(())
+
+	def load(self, segs):
+		"""segs: (start, end, use64) for every segment."""
+		segs = sorted(segs)
+		self.starts = [s[0] for s in segs]
+		self.ends = [s[1] for s in segs]
+		self.is64 = [bool(s[2]) for s in segs]
+
+	def use64(self, ea):
+		i = bisect_right(self.starts, ea) - 1
+		return i >= 0 and ea < self.ends[i] and self.is64[i]
+
+	def segment(self, ea):
+		i = bisect_right(self.starts, ea) - 1
+		if i >= 0 and ea < self.ends[i]:
+			return self.starts[i], self.ends[i], self.is64[i]
+		return None
@@ -0,0 +1,222 @@
+#  AArch64 mov simplifier decoders
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Everything here works on plain integers and callbacks, so the same code
+# runs inside the IDA plugins and in the headless a64fold.py.
+
+from a64bitmask import BITMASK_IMM
+
+SHIFT_NONE = 0
+SHIFT_LSL = 1
+SHIFT_LSR = 2
+SHIFT_ASR = 3
+
+# opcode classes, one bit per decoder
+OPC_MOV = 1					# may start a chain: ORR (immediate), MOVN, MOVZ
+OPC_MOVK = 2					# may only extend one: MOVK, ADD/SUB (immediate)
+OPC_SHIFT = 4					# UBFM/SBFM, maybe LSL/LSR/ASR
+OPC_PAGEOFF = 8					# may consume an ADRP: ADD (immediate), LDR/STR (unsigned offset)
+
+# (mask, value, class) over sf:opc:bits[28:23], i.e. opcode >> 23
+OPCLASS_PATTERNS = [
+	(0x0FF, 0x064, OPC_MOV),		# x 01 100100	ORR (immediate)
+	(0x07F, 0x025, OPC_MOV),		# x x0 100101	MOVN, MOVZ
+	(0x0FF, 0x0E5, OPC_MOVK),		# x 11 100101	MOVK
+	(0x03E, 0x022, OPC_MOVK),		# x xx 10001x	ADD/SUB (immediate)
+	(0x07F, 0x026, OPC_SHIFT),		# x x0 100110	SBFM, UBFM
+	(0x1FF, 0x122, OPC_PAGEOFF),		# 1 00 100010	ADD (immediate), 64-bit
+	(0x076, 0x072, OPC_PAGEOFF),		# x x1 11x01x	LDR/STR (unsigned offset)
+]
+
+# what the consumer of an ADRP does with the page
+PAGE_ADD = 1
+PAGE_LOAD = 2
+PAGE_STORE = 3
+
+# longest chain folded into one MOVE, in words; a longer run is split there
+CHAIN_WINDOW = 16
+
+def build_opclass(patterns=OPCLASS_PATTERNS):
+	table = bytearray(512)
+	for i in range(512):
+		for mask, value, cls in patterns:
+			if i & mask == value:
+				table[i] |= cls
+	return table
+
+# OPCLASS[opcode >> 23] is 0 for anything no decoder here wants to see
+OPCLASS = build_opclass()
+
+def DecodeMov(opcode, total, first):
+	# opc
+	o = (opcode >> 29) & 3
+	# constant
+	k = (opcode >> 23) & 0x3F
+
+	if k == 0x24 and o == 1:			# MOV (bitmask imm) <=> ORR (immediate)
+		# sf
+		s = (opcode >> 31) & 1
+		# N
+		N = (opcode >> 22) & 1
+		if s == 0 and N != 0:
+			return None
+		# rn
+		rn = (opcode >> 5) & 0x1F
+		if rn == 31:
+			# N:immr:imms
+			return BITMASK_IMM[(opcode >> 10) & 0x1FFF]
+	elif k == 0x25:					# MOVN/MOVZ/MOVK
+		# sf
+		s = (opcode >> 31) & 1
+		# hw
+		h = (opcode >> 21) & 3
+		# imm16
+		i = (opcode >> 5) & 0xFFFF
+		if s == 0 and h > 1:
+			return None
+		h *= 16
+		i <<= h
+		if o == 0:				# MOVN
+			return ~i
+		elif o == 2:				# MOVZ
+			return i
+		elif o == 3 and not first:		# MOVK
+			return (total & ~(0xFFFF << h)) | i
+	elif (k | 1) == 0x23 and not first:		# ADD (immediate)
+		# shift
+		h = (opcode >> 22) & 3
+		if h > 1:
+			return None
+		# rn
+		rd = opcode & 0x1F
+		rn = (opcode >> 5) & 0x1F
+		if rd != rn:
+			return None
+		# imm12
+		i = (opcode >> 10) & 0xFFF
+		h *= 12
+		i <<= h
+		if o & 2:				# SUB
+			return total - i
+		else:					# ADD
+			return total + i
+
+	return None
+
+def mov_sequence(ea, read_word, use64, is_target, window=CHAIN_WINDOW):
+	"""
+	Walk the MOVZ/MOVN/MOVK/ORR/ADD chain starting at ea, at most window
+	words of it.  Returns (length in bytes, register, is64, value).
+	"""
+	oldea = ea
+	end = ea + 4 * window
+	reg = -1
+	total = 0
+	is64 = False
+	while ea < end and use64(ea):
+		d = read_word(ea)
+		# reg
+		r = d & 0x1F
+		if reg >= 0 and reg != r:
+			break
+		newval = DecodeMov(d, total, reg < 0)
+		if newval is None:
+			break
+		if reg >= 0 and is_target(ea):
+			break
+		if (d >> 31) & 1:
+			is64 = True
+		total = newval
+		reg = r
+		ea += 4
+	return ea - oldea, reg, is64, total
+
+def decode_ubfm_shift(opcode):
+	"""Return (SHIFT_xxx, sf, amount) for the LSL/LSR/ASR aliases of UBFM/SBFM."""
+	# opc
+	o = (opcode >> 29) & 3
+	# constant
+	k = (opcode >> 23) & 0x3F
+	if (o & 1) == 0 and k == 0x26:
+		# sf
+		s = (opcode >> 31) & 1
+		# N
+		N = (opcode >> 22) & 1
+		if s == N:
+			# imm
+			imms = (opcode >> 10) & 0x3F
+			immr = (opcode >> 16) & 0x3F
+			mask = 0x1F | ((s & N) << 5)
+			if imms == mask:
+				return SHIFT_LSR if o else SHIFT_ASR, s, immr
+			elif immr == imms + 1 and o:
+				return SHIFT_LSL, s, mask - imms
+	return SHIFT_NONE, 0, 0
+
+def decode_adrp(opcode, ea):
+	"""Return (rd, page) for ADRP, else None."""
+	if (opcode & 0x9F000000) != 0x90000000:
+		return None
+	imm = ((opcode >> 3) & 0x1FFFFC) | ((opcode >> 29) & 3)
+	imm -= (imm & 0x100000) << 1
+	return opcode & 0x1F, ((ea & ~0xFFF) + (imm << 12)) & 0xFFFFFFFFFFFFFFFF
+
+def decode_pageoff(opcode):
+	"""
+	Return (rd, rn, offset, PAGE_xxx) for the instructions that add a page
+	offset to a base register: 64-bit ADD (immediate) and the unsigned
+	offset forms of LDR/STR.  rd is Rt for loads and stores.
+	"""
+	if (opcode & 0xFFC00000) == 0x91000000:		# ADD Xd, Xn, #imm12
+		return opcode & 0x1F, (opcode >> 5) & 0x1F, (opcode >> 10) & 0xFFF, PAGE_ADD
+	if (opcode & 0x3B000000) == 0x39000000:		# LDR/STR (unsigned offset)
+		# size
+		scale = opcode >> 30
+		# V
+		v = (opcode >> 26) & 1
+		# opc
+		o = (opcode >> 22) & 3
+		if v and o & 2:
+			if scale:
+				return None
+			scale = 4				# Q register
+		if v:
+			kind = PAGE_LOAD if o & 1 else PAGE_STORE
+		else:
+			kind = PAGE_LOAD if o else PAGE_STORE
+		return opcode & 0x1F, (opcode >> 5) & 0x1F, ((opcode >> 10) & 0xFFF) << scale, kind
+	return None
+
+def is_flow_break(opcode):
+	"""B, BL, B.cond, CBZ/CBNZ, TBZ/TBNZ, BR/BLR/RET/ERET."""
+	return ((opcode & 0x7C000000) == 0x14000000 or (opcode & 0xFF000010) == 0x54000000 or
+		(opcode & 0x7E000000) == 0x34000000 or (opcode & 0x7E000000) == 0x36000000 or
+		(opcode & 0xFE000000) == 0xD6000000)
+
+def ldst_writes(opcode):
+	"""
+	Registers a load or store writes besides Rt: Rn of the pre/post-index
+	forms (and the post-index LD1..LD4/ST1..ST4) and Rt2 of LDP/LDPSW.
+	"""
+	out = []
+	pair = (opcode & 0x3A000000) == 0x28000000
+	if ((pair and (opcode >> 23) & 1) or (opcode & 0x3B200400) == 0x38000400 or
+		(opcode & 0xBE800000) == 0x0C800000):
+		out.append((opcode >> 5) & 0x1F)
+	if pair and (opcode & 0x04400000) == 0x00400000:
+		out.append((opcode >> 10) & 0x1F)
+	return out
@@ -0,0 +1,610 @@
+#  AArch64 mov simplifier batch scanner
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Decodes a whole segment at once instead of one word per analysis
+# callback.  Word classification mirrors DecodeMov; only the (rare)
+# foldable chains are then walked in Python to compute their value.
+# ADRP page pairs are matched the same way, a few words ahead at a time,
+# and chains interleaved with other code per register within a block.
+# Without NumPy the same results come from a plain per-word loop.
+
+from array import array
+from bisect import bisect_left
+import sys
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from a64bitmask import BITMASK_IMM
+from simpcore import DecodeMov, mov_sequence, decode_adrp, decode_pageoff, is_flow_break, ldst_writes
+from simpcore import CHAIN_WINDOW
+from simpcore import PAGE_ADD, PAGE_LOAD, PAGE_STORE
+from simpcore import OPCLASS, OPC_SHIFT, SHIFT_NONE, decode_ubfm_shift
+
+if numpy is not None:
+	BITMASK_VALID = numpy.array([v is not None for v in BITMASK_IMM], dtype=bool)
+	OPCLASS_NP = numpy.frombuffer(bytes(OPCLASS), dtype=numpy.uint8)
+
+class ChainIndex(object):
+	"""Foldable chains of one segment, sorted by start address."""
+
+	def __init__(self, eas=(), sizes=(), regs=(), is64=(), values=()):
+		self.eas = list(eas)
+		self.sizes = list(sizes)
+		self.regs = list(regs)
+		self.is64 = list(is64)
+		self.values = list(values)
+
+	def __len__(self):
+		return len(self.eas)
+
+	def __iter__(self):
+		for i in range(len(self.eas)):
+			yield self.eas[i], (self.sizes[i], self.regs[i], self.is64[i], self.values[i])
+
+	def lookup(self, ea):
+		i = bisect_left(self.eas, ea)
+		if i < len(self.eas) and self.eas[i] == ea:
+			return self.sizes[i], self.regs[i], self.is64[i], self.values[i]
+		return None
+
+	def overlapping(self, start, end):
+		"""Start addresses of the chains touching [start, end)."""
+		i = bisect_left(self.eas, start)
+		# chains starting before start may still reach into the window
+		j = i
+		while j > 0 and self.eas[j - 1] + self.sizes[j - 1] > start:
+			j -= 1
+		out = []
+		while j < len(self.eas) and self.eas[j] < end:
+			if self.eas[j] + self.sizes[j] > start:
+				out.append(self.eas[j])
+			j += 1
+		return out
+
+class TrackIndex(object):
+	"""
+	Chains interleaved with other code, sorted by the address of their
+	last word, which is where the folded value is complete.
+	"""
+
+	def __init__(self, eas=(), heads=(), regs=(), is64=(), values=()):
+		self.eas = list(eas)
+		self.heads = list(heads)
+		self.regs = list(regs)
+		self.is64 = list(is64)
+		self.values = list(values)
+
+	def __len__(self):
+		return len(self.eas)
+
+	def __iter__(self):
+		for i in range(len(self.eas)):
+			yield self.eas[i], (self.heads[i], (4, self.regs[i], self.is64[i], self.values[i]))
+
+class PairIndex(object):
+	"""ADRP consumers of one segment, sorted by address."""
+
+	def __init__(self, eas=(), targets=(), kinds=(), adrps=()):
+		self.eas = list(eas)
+		self.targets = list(targets)
+		self.kinds = list(kinds)
+		self.adrps = list(adrps)
+
+	def __len__(self):
+		return len(self.eas)
+
+	def __iter__(self):
+		for i in range(len(self.eas)):
+			yield self.eas[i], (self.targets[i], self.kinds[i], self.adrps[i])
+
+	def lookup(self, ea):
+		"""(target, PAGE_xxx, ADRP address) for a consumer, else None."""
+		i = bisect_left(self.eas, ea)
+		if i < len(self.eas) and self.eas[i] == ea:
+			return self.targets[i], self.kinds[i], self.adrps[i]
+		return None
+
+	def cut(self, start, end):
+		"""
+		Remove the pairs whose ADRP is before end and consumer at or after
+		start, i.e. the ones a target at start or a patch of [start, end)
+		breaks.  Returns them the way iterating yields them.
+		"""
+		out = []
+		i = bisect_left(self.eas, start)
+		while i < len(self.eas) and self.eas[i] < end + 4 * PAIR_WINDOW:
+			if self.adrps[i] < end:
+				out.append((self.eas[i], (self.targets[i], self.kinds[i], self.adrps[i])))
+				for field in (self.eas, self.targets, self.kinds, self.adrps):
+					del field[i]
+			else:
+				i += 1
+		return out
+
+def load_words(data):
+	return numpy.frombuffer(data, dtype="<u4", count=len(data) // 4).astype(numpy.uint32)
+
+def word_array(data):
+	words = array("I")
+	data = data[:len(data) // 4 * 4]
+	if hasattr(words, "frombytes"):
+		words.frombytes(data)
+	else:
+		words.fromstring(data)
+	if sys.byteorder == "big":
+		words.byteswap()
+	return words
+
+def packbits(mask):
+	"""bool array -> bytearray with bit (i & 7) of byte i >> 3 set for mask[i]."""
+	pad = -len(mask) % 8
+	if pad:
+		mask = numpy.concatenate([mask, numpy.zeros(pad, dtype=bool)])
+	return bytearray(numpy.packbits(mask.reshape(-1, 8)[:, ::-1]).tobytes())
+
+def sext(x, bits):
+	return (x ^ (1 << (bits - 1))) - (1 << (bits - 1))
+
+def branch_targets(data):
+	"""
+	Decode every B/BL/B.cond/CBZ/CBNZ/TBZ/TBNZ in data at once.  Returns a
+	packbits() bitmap of the words they target and the indices of the
+	BR/BLR words, whose targets only the database knows.
+	"""
+	if numpy is None:
+		return branch_targets_py(data)
+	words = load_words(data)
+	n = len(words)
+	w = words.astype(numpy.int64)
+	off = numpy.zeros(n, dtype=numpy.int64)
+	b = (words & 0x7C000000) == 0x14000000		# B, BL
+	off[b] = sext(w[b] & 0x3FFFFFF, 26)
+	imm19 = ((words & 0xFF000010) == 0x54000000) | ((words & 0x7E000000) == 0x34000000)
+	off[imm19] = sext((w[imm19] >> 5) & 0x7FFFF, 19)	# B.cond, CBZ, CBNZ
+	tb = (words & 0x7E000000) == 0x36000000		# TBZ, TBNZ
+	off[tb] = sext((w[tb] >> 5) & 0x3FFF, 14)
+
+	branch = b | imm19 | tb
+	target = numpy.flatnonzero(branch) + off[branch]
+	hits = numpy.zeros(n, dtype=bool)
+	hits[target[(target >= 0) & (target < n)]] = True
+	indirect = numpy.flatnonzero((words & 0xFFDFFC1F) == 0xD61F0000)	# BR, BLR
+	return packbits(hits), indirect.tolist()
+
+def branch_targets_py(data):
+	words = word_array(data)
+	n = len(words)
+	bits = bytearray((n + 7) // 8)
+	indirect = []
+	for i, d in enumerate(words):
+		if (d & 0x7C000000) == 0x14000000:
+			t = i + sext(d & 0x3FFFFFF, 26)
+		elif (d & 0xFF000010) == 0x54000000 or (d & 0x7E000000) == 0x34000000:
+			t = i + sext((d >> 5) & 0x7FFFF, 19)
+		elif (d & 0x7E000000) == 0x36000000:
+			t = i + sext((d >> 5) & 0x3FFF, 14)
+		else:
+			if (d & 0xFFDFFC1F) == 0xD61F0000:
+				indirect.append(i)
+			continue
+		if 0 <= t < n:
+			bits[t >> 3] |= 1 << (t & 7)
+	return bits, indirect
+
+def classify(words):
+	"""Return (start, cont) masks: words that may begin / extend a chain."""
+	o = (words >> 29) & 3
+	k = (words >> 23) & 0x3F
+	s = words >> 31
+	h = (words >> 21) & 3
+	rd = words & 0x1F
+	rn = (words >> 5) & 0x1F
+
+	orr = (k == 0x24) & (o == 1) & ((s != 0) | (((words >> 22) & 1) == 0))
+	orr &= (rn == 31) & BITMASK_VALID[(words >> 10) & 0x1FFF]
+	mov = (k == 0x25) & ((s != 0) | (h < 2))
+	start = orr | (mov & ((o == 0) | (o == 2)))
+	add = ((k | 1) == 0x23) & (((words >> 22) & 3) < 2) & (rd == rn)
+	cont = start | (mov & (o == 3)) | add
+	return start, cont
+
+def scan_chains(start_ea, data, is_target=None, window=CHAIN_WINDOW):
+	"""
+	Find every foldable MOVZ/MOVN/MOVK/ORR/ADD chain in data, which holds
+	the bytes of a 64-bit segment at start_ea.  is_target(ea) tells if a
+	continuation word is a code reference target, which ends the chain.
+	Like mov_sequence, a chain stops after window words.
+	"""
+	if numpy is None:
+		return scan_chains_py(start_ea, data, is_target, window)
+	words = load_words(data)
+	n = len(words)
+	if n < 2:
+		return ChainIndex()
+	start, cont = classify(words)
+
+	rd = words & 0x1F
+	# link[j]: word j extends a chain that reached word j - 1
+	link = numpy.zeros(n, dtype=bool)
+	link[1:] = cont[1:] & (rd[1:] == rd[:-1]) & cont[:-1]
+	if is_target is not None:
+		for j in numpy.flatnonzero(link):
+			if is_target(start_ea + 4 * int(j)):
+				link[j] = False
+
+	# a chain runs from its head up to the next word that does not link
+	breaks = numpy.append(numpy.flatnonzero(~link), n)
+	heads = numpy.flatnonzero(start[:-1] & link[1:])
+	ends = breaks[numpy.searchsorted(breaks, heads, side="right")]
+	ends = numpy.minimum(ends, heads + window)
+	index = ChainIndex()
+	for i, e in zip(heads.tolist(), ends.tolist()):
+		total = 0
+		is64 = False
+		first = True
+		for d in words[i:e].tolist():
+			total = DecodeMov(d, total, first)
+			first = False
+			if d >> 31:
+				is64 = True
+		index.eas.append(start_ea + 4 * i)
+		index.sizes.append(4 * (e - i))
+		index.regs.append(int(rd[i]))
+		index.is64.append(is64)
+		index.values.append(total)
+	return index
+
+def scan_chains_py(start_ea, data, is_target=None, window=CHAIN_WINDOW):
+	words = word_array(data)
+	end = start_ea + 4 * len(words)
+	read_word = lambda ea: words[(ea - start_ea) >> 2]
+	use64 = lambda ea: start_ea <= ea < end
+	if is_target is None:
+		is_target = lambda ea: False
+	index = ChainIndex()
+	for i, d in enumerate(words):
+		if DecodeMov(d, 0, True) is None:
+			continue
+		size, reg, is64, value = mov_sequence(start_ea + 4 * i, read_word, use64, is_target, window)
+		if size > 4:
+			index.eas.append(start_ea + 4 * i)
+			index.sizes.append(size)
+			index.regs.append(reg)
+			index.is64.append(is64)
+			index.values.append(value)
+	return index
+
+def _track_index(start_ea, found):
+	found.sort()
+	index = TrackIndex()
+	for last, first, reg, is64, total in found:
+		index.eas.append(start_ea + 4 * last)
+		index.heads.append(start_ea + 4 * first)
+		index.regs.append(reg)
+		index.is64.append(is64)
+		index.values.append(total)
+	return index
+
+# how many words past its head an interleaved chain may end
+TRACK_WINDOW = 32
+
+def track_chains(start_ea, data, targets=None, window=TRACK_WINDOW):
+	"""
+	Find the chains scan_chains misses because other instructions sit
+	between their words, e.g. two registers loaded MOVZ, MOVZ, MOVK, MOVK.
+	Per block, each register keeps the partial value of its chain until
+	something else writes it.  A branch or a set bit in the targets bitmap
+	ends the block.  Loads and stores also end the chains of their base
+	and second register, and chains longer than window words are dropped,
+	which only loses folds.  Chains with no gap are left to scan_chains.
+	"""
+	if numpy is None:
+		return track_chains_py(start_ea, data, targets, window)
+	words = load_words(data)
+	n = len(words)
+	if n < 3:
+		return TrackIndex()
+	start, cont = classify(words)
+	rd = words & 0x1F
+
+	# boundary after word i: a branch at i or a target at i + 1
+	stop = ((words & 0x7C000000) == 0x14000000) | ((words & 0xFF000010) == 0x54000000)
+	stop |= ((words & 0x7E000000) == 0x34000000) | ((words & 0x7E000000) == 0x36000000)
+	stop |= (words & 0xFE000000) == 0xD6000000
+	if targets is not None:
+		stop[:-1] |= unpackbits(targets, n)[1:]
+	blocks = numpy.zeros(n + 1, dtype=numpy.int64)
+	numpy.cumsum(stop, out=blocks[1:])
+
+	# chain words grouped by register, each one paired with the previous
+	pos = numpy.flatnonzero(cont)
+	if not len(pos):
+		return TrackIndex()
+	pos = pos[numpy.argsort(rd[pos], kind="stable")]
+	a, b = pos[:-1], pos[1:]
+	reg = rd[b]
+	# a MOVZ/MOVN/ORR always starts over, so it never extends the previous word
+	link = (rd[a] == reg) & ~start[b] & (blocks[b] == blocks[a])
+	# in between, nothing else may write the register
+	gap = numpy.where(link, b - a - 1, 0)
+	cand = numpy.flatnonzero(gap)
+	if len(cand):
+		g = gap[cand]
+		at = numpy.repeat(a[cand] + 1 - numpy.cumsum(g) + g, g) + numpy.arange(int(g.sum()))
+		r = numpy.repeat(reg[cand], g)
+		w = words[at]
+		ldst = (w & 0x0A000000) == 0x08000000
+		kill = ~cont[at] & ((rd[at] == r) | (ldst & ((((w >> 5) & 0x1F) == r) | (((w >> 10) & 0x1F) == r))))
+		hit = numpy.bincount(numpy.repeat(numpy.arange(len(cand)), g), weights=kill, minlength=len(cand))
+		link[cand[hit > 0]] = False
+
+	# only linked runs with a gap somewhere are new
+	heads = numpy.flatnonzero(numpy.append(True, ~link))
+	ends = numpy.append(heads[1:], len(pos))
+	span = pos[ends - 1] - pos[heads]
+	keep = (ends - heads > 1) & start[pos[heads]] & (span != ends - 1 - heads) & (span <= window)
+	found = []
+	for h, e in zip(heads[keep].tolist(), ends[keep].tolist()):
+		total = 0
+		is64 = False
+		first = True
+		for d in words[pos[h:e]].tolist():
+			total = DecodeMov(d, total, first)
+			first = False
+			if d >> 31:
+				is64 = True
+		found.append((int(pos[e - 1]), int(pos[h]), int(rd[pos[h]]), is64, total))
+	return _track_index(start_ea, found)
+
+def track_chains_py(start_ea, data, targets=None, window=TRACK_WINDOW):
+	words = word_array(data)
+	found = []
+	live = {}						# reg -> [value, first, last, words, is64]
+	def retire(s, reg):
+		if s[3] > 1 and s[2] - s[1] != s[3] - 1 and s[2] - s[1] <= window:
+			found.append((s[2], s[1], reg, s[4], s[0]))
+	for i, d in enumerate(words):
+		if live and targets is not None and targets[i >> 3] & (1 << (i & 7)):
+			for r, s in live.items():
+				retire(s, r)
+			live.clear()
+		r = d & 0x1F
+		total = DecodeMov(d, 0, True)
+		if total is not None:
+			if r in live:
+				retire(live[r], r)
+			live[r] = [total, i, i, 1, bool(d >> 31)]
+			continue
+		if not live:
+			continue
+		s = live.get(r)
+		if s is not None:
+			total = DecodeMov(d, s[0], False)
+			if total is not None:
+				s[0] = total
+				s[2] = i
+				s[3] += 1
+				if d >> 31:
+					s[4] = True
+				continue
+		elif DecodeMov(d, 0, False) is not None:
+			continue
+		if is_flow_break(d):
+			for r, s in live.items():
+				retire(s, r)
+			live.clear()
+			continue
+		kill = [r]
+		if (d & 0x0A000000) == 0x08000000:		# loads and stores
+			kill += [(d >> 5) & 0x1F, (d >> 10) & 0x1F]
+		for r in kill:
+			s = live.pop(r, None)
+			if s is not None:
+				retire(s, r)
+	for r, s in live.items():
+		retire(s, r)
+	return _track_index(start_ea, found)
+
+def shift_aliases(start_ea, data):
+	"""Addresses of the UBFM/SBFM words that decode as LSL/LSR/ASR."""
+	if numpy is None:
+		cand = [(i, d) for i, d in enumerate(word_array(data)) if OPCLASS[d >> 23] & OPC_SHIFT]
+	else:
+		words = load_words(data)
+		i = numpy.flatnonzero(OPCLASS_NP[words >> 23] & OPC_SHIFT)
+		cand = zip(i.tolist(), words[i].tolist())
+	return [start_ea + 4 * i for i, d in cand if decode_ubfm_shift(d)[0] != SHIFT_NONE]
+
+# how far past an ADRP its consumers are looked for
+PAIR_WINDOW = 8
+
+def unpackbits(bits, n):
+	b = numpy.frombuffer(bytes(bits), dtype=numpy.uint8)
+	return numpy.unpackbits(b).reshape(-1, 8)[:, ::-1].ravel()[:n].astype(bool)
+
+def scan_pages(start_ea, data, targets=None, window=PAIR_WINDOW):
+	"""
+	Pair every ADRP in data with the ADD/LDR/STR that use its register
+	within the next window words.  A pair is only made inside one block:
+	a branch, a code reference target (a set bit in the targets bitmap,
+	see branch_targets) or another write to the register, LDP's Rt2 and
+	a writeback to the base register included, ends the ADRP.  Stores
+	whose Rt is the register end it too, which only loses pairs.
+	"""
+	if numpy is None:
+		return scan_pages_py(start_ea, data, targets, window)
+	words = load_words(data)
+	n = len(words)
+	adrp = numpy.flatnonzero((words & 0x9F000000) == 0x90000000)
+	if not len(adrp):
+		return PairIndex()
+	w = words.astype(numpy.int64)
+	rd = words & 0x1F
+	rn = (words >> 5) & 0x1F
+	imm12 = (w >> 10) & 0xFFF
+
+	add = (words & 0xFFC00000) == 0x91000000
+	ldst = (words & 0x3B000000) == 0x39000000
+	scale = words >> 30
+	v = ((words >> 26) & 1).astype(bool)
+	opc = (words >> 22) & 3
+	q = v & ((opc & 2) != 0)
+	ldst &= ~q | (scale == 0)
+	scale = numpy.where(q, 4, scale).astype(numpy.int64)
+	load = numpy.where(v, (opc & 1) != 0, opc != 0)
+	offset = numpy.where(add, imm12, imm12 << scale)
+	kind = numpy.where(add, PAGE_ADD, numpy.where(load, PAGE_LOAD, PAGE_STORE))
+	consumer = add | ldst
+	# the other registers loads and stores write, see simpcore.ldst_writes
+	pair = (words & 0x3A000000) == 0x28000000
+	wback = (pair & (((words >> 23) & 1) != 0)) | ((words & 0x3B200400) == 0x38000400)
+	wback |= (words & 0xBE800000) == 0x0C800000
+	rt2 = numpy.where(pair & ((words & 0x04400000) == 0x00400000), (words >> 10) & 0x1F, 32)
+
+	stop = ((words & 0x7C000000) == 0x14000000) | ((words & 0xFF000010) == 0x54000000)
+	stop |= ((words & 0x7E000000) == 0x34000000) | ((words & 0x7E000000) == 0x36000000)
+	stop |= (words & 0xFE000000) == 0xD6000000
+	entry = unpackbits(targets, n) if targets is not None else numpy.zeros(n, dtype=bool)
+
+	imm = ((w[adrp] >> 3) & 0x1FFFFC) | ((w[adrp] >> 29) & 3)
+	imm -= (imm & 0x100000) << 1
+	base = (numpy.uint64(start_ea) + (adrp * 4).astype(numpy.uint64)) & numpy.uint64(~0xFFF & 0xFFFFFFFFFFFFFFFF)
+	page = base + (imm << 12).astype(numpy.uint64)
+	reg = rd[adrp]
+
+	eas, tgts, kinds, srcs = [], [], [], []
+	alive = numpy.ones(len(adrp), dtype=bool)
+	for k in range(1, window + 1):
+		j = adrp + k
+		alive &= j < n
+		if not alive.any():
+			break
+		j = numpy.where(alive, j, 0)
+		alive &= ~entry[j]
+		hit = alive & consumer[j] & (rn[j] == reg)
+		if hit.any():
+			h = numpy.flatnonzero(hit)
+			jj = j[h]
+			eas.append(jj)
+			tgts.append(page[h] + offset[jj].astype(numpy.uint64))
+			kinds.append(kind[jj])
+			srcs.append(adrp[h])
+		alive &= ~stop[j] & (rd[j] != reg) & (rt2[j] != reg) & ~(wback[j] & (rn[j] == reg))
+
+	if not eas:
+		return PairIndex()
+	eas = numpy.concatenate(eas)
+	order = numpy.argsort(eas, kind="stable")
+	return PairIndex(
+		[start_ea + 4 * i for i in eas[order].tolist()],
+		numpy.concatenate(tgts)[order].tolist(),
+		numpy.concatenate(kinds)[order].tolist(),
+		[start_ea + 4 * i for i in numpy.concatenate(srcs)[order].tolist()])
+
+def scan_pages_py(start_ea, data, targets=None, window=PAIR_WINDOW):
+	words = word_array(data)
+	index = PairIndex()
+	live = {}						# reg -> (index, page)
+	for i, d in enumerate(words):
+		if live:
+			if targets is not None and targets[i >> 3] & (1 << (i & 7)):
+				live.clear()
+			else:
+				for r in [r for r, (a, p) in live.items() if i - a > window]:
+					del live[r]
+				c = decode_pageoff(d)
+				if c is not None and c[1] in live:
+					a, p = live[c[1]]
+					index.eas.append(start_ea + 4 * i)
+					index.targets.append((p + c[2]) & 0xFFFFFFFFFFFFFFFF)
+					index.kinds.append(c[3])
+					index.adrps.append(start_ea + 4 * a)
+				if is_flow_break(d):
+					live.clear()
+				else:
+					for r in [d & 0x1F] + ldst_writes(d):
+						live.pop(r, None)
+		a = decode_adrp(d, start_ea + 4 * i)
+		if a is not None:
+			live[a[0]] = (i, a[1])
+	return index
+
+def _random_words(rnd, n):
+	"""Code shaped to hit the scanners' corner cases, registers from a few."""
+	bitmask = [i for i, v in enumerate(BITMASK_IMM) if v is not None]
+	reg = lambda: rnd.randrange(4)
+	out = []
+	while len(out) < n:
+		x = rnd.random()
+		if x < 0.25:
+			sf = rnd.getrandbits(1)
+			op = rnd.choice([0x52800000, 0x12800000, 0x72800000])	# MOVZ, MOVN, MOVK
+			out.append(op | (sf << 31) | (rnd.randrange(4 if sf else 2) << 21) | (rnd.getrandbits(16) << 5) | reg())
+		elif x < 0.3:
+			out.append(0xB2000000 | (rnd.choice(bitmask) << 10) | (31 << 5) | reg())	# ORR
+		elif x < 0.4:
+			out.append(0x91000000 | (rnd.getrandbits(1) << 30) | (rnd.getrandbits(12) << 10) | (reg() << 5) | reg())
+		elif x < 0.5:
+			out.append(0x90000000 | (rnd.getrandbits(2) << 29) | (rnd.getrandbits(19) << 5) | reg())	# ADRP
+		elif x < 0.6:
+			out.append(rnd.choice([0xF9400000, 0xF9000000, 0x3D400000]) | (rnd.getrandbits(12) << 10) | (reg() << 5) | reg())
+		elif x < 0.67:
+			# LDP/STP (offset, post, pre), LDR post-index, LD1 post-index
+			op = rnd.choice([0xA9400000, 0xA9000000, 0xA8C00000, 0xA9C00000, 0x6D400000, 0xF8400400, 0x4CDF7000])
+			out.append(op | (reg() << 10) | (reg() << 5) | reg())
+		elif x < 0.72:
+			op = rnd.choice([0x14000000, 0x94000000, 0x54000000, 0xB4000000, 0x36000000, 0xD65F03C0, 0xD61F0000])
+			off = rnd.randrange(-16, 16)
+			out.append(op | ((off & 0x3FFFFFF) if op & 0x7C000000 == 0x14000000 else (off & 0x3FFF) << 5))
+		else:
+			out.append(rnd.getrandbits(32))
+	return out[:n]
+
+def check_scanners(rounds=200, seed=0):
+	"""The NumPy scanners against their plain Python fallbacks."""
+	import random
+	import struct
+	if numpy is None:
+		raise AssertionError("NumPy is not installed, only the fallbacks run")
+	rnd = random.Random(seed)
+	start_ea = 0xFFFFFFF007004000
+	for i in range(rounds):
+		n = rnd.choice([0, 1, 2, 3, 5, 17, 64, 300, 2000])
+		data = struct.pack("<%dI" % n, *_random_words(rnd, n))
+		bits, indirect = branch_targets(data)
+		assert (bits, indirect) == branch_targets_py(data), i
+		# some targets only the database knows
+		for w in range(n):
+			if rnd.random() < 0.02:
+				bits[w >> 3] |= 1 << (w & 7)
+		test = lambda ea: bool(bits[((ea - start_ea) >> 2) >> 3] & (1 << (((ea - start_ea) >> 2) & 7)))
+		assert list(scan_chains(start_ea, data, test)) == list(scan_chains_py(start_ea, data, test)), i
+		for targets in (None, bits):
+			assert list(track_chains(start_ea, data, targets)) == list(track_chains_py(start_ea, data, targets)), i
+			assert list(scan_pages(start_ea, data, targets)) == list(scan_pages_py(start_ea, data, targets)), i
+	# a run of MOVKs far longer than a chain may be
+	data = struct.pack("<I", 0xD2800000) + struct.pack("<I", 0xF2A00000) * (4 * CHAIN_WINDOW)
+	chains = list(scan_chains(start_ea, data))
+	assert chains == list(scan_chains_py(start_ea, data))
+	assert chains and max(r[0] for ea, r in chains) == 4 * CHAIN_WINDOW
+
+if __name__ == "__main__":
+	check_scanners()
+	print("scan_chains, track_chains, scan_pages match their fallbacks: OK")
@@ -0,0 +1,206 @@
+#  SCC benchmark
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Runs outside IDA, on synthetic call graphs shaped like a kernelcache's:
+#
+#   python bench_scc.py [--sizes 1000,10000,...] [--seed N] [-o results.json]
+#
+# Every size gets graph construction (dict and CSRGraph), the components
+# (iterative on both forms, the recursive one while it fits the stack), the
+# condensation DAG and the output stage timed, then run again under
+# tracemalloc for the peak memory of each (py3; null on py2, or with
+# --no-memory).  The JSON goes to stdout or -o, so runs can be diffed.
+
+import argparse
+from array import array
+import json
+import platform
+import random
+import sys
+from timeit import default_timer as clock
+
+import scc
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BASE = 0xFFFFFFF007004000
+SIZES = [1000, 10000, 100000, 1000000, 2000000]
+# the recursive Tarjan is only run up to this many nodes
+RECURSIVE_MAX = 10000
+
+
+def kernel_graph(n, seed=0, alpha=1.6, clusters=3, chains=4, loops=0.01):
+    """
+    Edges (caller, callee) as two arrays of node indices, node i at BASE + 16 * i.
+
+    Most functions call a few others and a few call hundreds (Pareto out
+    degree), callees lean towards low indices, the memcpy's and lock helpers
+    everyone calls.  Calls go to lower indices, so apart from what is added
+    below the graph is a DAG, like most of a kernel:
+      - chains of n / 20 functions each calling the next one down, for depth,
+      - clusters of n / 50 functions calling around in a ring plus random
+        calls inside, the giant mutually recursive components,
+      - a loops fraction of functions calling themselves,
+      - one in a thousand calling a little way up, small mutual recursions.
+    """
+    rnd = random.Random(seed)
+    src = array('l')
+    dst = array('l')
+    for i in range(1, n):
+        for k in range(min(int(rnd.paretovariate(alpha)) - 1, 256)):
+            src.append(i)
+            dst.append(int(i * rnd.random() ** 2))
+        if rnd.random() < loops:
+            src.append(i)
+            dst.append(i)
+        if rnd.random() < 0.001 and i + 50 < n:
+            src.append(i)
+            dst.append(i + rnd.randrange(1, 50))
+    length = max(2, n // 20)
+    for c in range(chains):
+        start = rnd.randrange(n - length + 1)
+        for i in range(start + 1, start + length):
+            src.append(i)
+            dst.append(i - 1)
+    size = max(2, n // 50)
+    for c in range(clusters):
+        start = rnd.randrange(n - size + 1)
+        for i in range(start, start + size):
+            src.append(i)
+            dst.append(i - 1 if i > start else start + size - 1)
+            src.append(i)
+            dst.append(start + rnd.randrange(size))
+    return src, dst
+
+
+def pairs(src, dst):
+    for s, d in zip(src, dst):
+        yield BASE + 16 * s, BASE + 16 * d
+
+
+def build_dict(src, dst):
+    """The {ea: successor eas} form tarjan.py used to build."""
+    graph = {}
+    for s, d in pairs(src, dst):
+        graph.setdefault(s, set()).add(d)
+    return graph
+
+
+def output_stage(result):
+    """
+    What tarjan.py does with the components, written to a counting sink:
+    largest first, names resolved in one pass, one JSON line each.
+    """
+    class Sink(object):
+        size = 0
+
+        def write(self, s):
+            self.size += len(s)
+
+    sink = Sink()
+    rows = sorted(result, key=len, reverse=True)
+    names = dict((f, "sub_%X" % f) for r in rows for f in r)
+    for i, r in enumerate(rows):
+        sink.write(json.dumps({"cluster": i, "size": len(r),
+                               "functions": [{"ea": ea, "name": names[ea]} for ea in r]}))
+        sink.write("\n")
+    return sink.size
+
+
+def stage(fn, memory):
+    """(result, {seconds, peak_bytes}) of fn(), timed and then traced."""
+    t = clock()
+    result = fn()
+    seconds = clock() - t
+    peak = None
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, {"seconds": seconds, "peak_bytes": peak}
+
+
+def bench(n, seed, memory):
+    t = clock()
+    src, dst = kernel_graph(n, seed)
+    generate = clock() - t
+    stages = {}
+    graph, stages["build_dict"] = stage(lambda: build_dict(src, dst), memory)
+    # functions that call nothing and nobody calls are nodes too
+    nodes = lambda: (BASE + 16 * i for i in range(n))
+    csr, stages["build_csr"] = stage(lambda: scc.CSRGraph.from_edges(pairs(src, dst), nodes()), memory)
+    result, stages["scc_dict"] = stage(lambda: scc.strongly_connected_components(graph), memory)
+    check, stages["scc_csr"] = stage(lambda: scc.strongly_connected_components(csr), memory)
+    canon = lambda result: sorted(sorted(c) for c in result)
+    assert canon(check) == canon(result)
+    if n <= RECURSIVE_MAX:
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 4 * n))
+        try:
+            check, stages["scc_recursive"] = stage(lambda: scc.strongly_connected_components_recursive(graph), memory)
+        finally:
+            sys.setrecursionlimit(limit)
+        assert check == result
+    dag, stages["condensation"] = stage(lambda: scc.Condensation.from_graph(csr), memory)
+    written, stages["output"] = stage(lambda: output_stage(result), memory)
+    sizes = sorted((len(c) for c in result), reverse=True)
+    return {
+        "nodes": len(csr),
+        "edges": csr.edges,
+        "generate_seconds": generate,
+        "components": len(result),
+        "largest": sizes[:5],
+        "self_loops": sum(1 for c in result if len(c) == 1),
+        "generate_edges": len(src),
+        "levels": len(dag.levels),
+        "output_bytes": written,
+        "stages": stages,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="SCC cost on synthetic kernel-like call graphs")
+    ap.add_argument("--sizes", default=",".join(str(n) for n in SIZES), help="comma separated node counts")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    ap.add_argument("-o", "--output", help="write the JSON here instead of stdout")
+    args = ap.parse_args()
+
+    graphs = []
+    for n in [int(s) for s in args.sizes.split(",")]:
+        sys.stderr.write("%d nodes\n" % n)
+        graphs.append(bench(n, args.seed, not args.no_memory))
+    report = json.dumps({
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "tracemalloc": tracemalloc is not None and not args.no_memory,
+        "seed": args.seed,
+        "graphs": graphs,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1006 @@
+#  Strongly connected components
+#
+#  Copyright (c) 2015 xerub
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# No IDA imports, so this also runs outside IDA:
+#
+#   python scc.py
+#
+# checks the iterative Tarjan against the recursive one, the CSRGraph form
+# against the dict one, IncrementalSCC against recomputing after every edit,
+# and that run_bottom_up starts no component before its callees finished,
+# on random graphs.
+#
+# For bottom-up batch jobs over a saved condensation:
+#
+#   dag = scc.load_condensation("kernel.sccdag.json")
+#   for cid, result in scc.run_bottom_up(dag, job, processes=8):
+#       ...
+#
+# A CSRGraph saves to a file that load_graph maps back without copying the
+# arrays (on py3, py2 copies them): a header, the node addresses, the row
+# offsets and the targets, all little endian.
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+def _ea_typecode():
+    # py2 has no 'Q', its 'L' is only 64 bits wide on some platforms
+    for code in ('Q', 'L'):
+        try:
+            if array(code).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    return None
+
+EA_TYPECODE = _ea_typecode()
+
+
+def ea_array(items=()):
+    """array of 64-bit addresses, or a list where array has no such type."""
+    if EA_TYPECODE is None:
+        return list(items)
+    return array(EA_TYPECODE, items)
+
+
+class CSRGraph(object):
+    """
+    Graph in compressed sparse row form.  Node i has address eas[i] (sorted, so
+    node(ea) is a bisect) and its successors are the node ids
+    targets[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, eas, offsets, targets, buf=None):
+        self.eas = eas
+        self.offsets = offsets
+        self.targets = targets
+        self._reverse = None
+        # the mapping the arrays are views of, if they came from load_graph
+        self.buf = buf
+
+    @classmethod
+    def from_edges(cls, edges, nodes=()):
+        """From (source, target) address pairs, plus nodes.  Duplicates are dropped."""
+        srcs = ea_array()
+        dsts = ea_array()
+        for s, d in edges:
+            srcs.append(s)
+            dsts.append(d)
+        nodes = sorted(set(srcs).union(dsts, nodes))
+        ids = dict((ea, i) for i, ea in enumerate(nodes))
+        keys = sorted(set((ids[s] << 32) | ids[d] for s, d in zip(srcs, dsts)))
+        srcs = dsts = ids = None
+        offsets = array('I', [0]) * (len(nodes) + 1)
+        for k in keys:
+            offsets[(k >> 32) + 1] += 1
+        for i in range(len(nodes)):
+            offsets[i + 1] += offsets[i]
+        targets = array('I', (k & 0xFFFFFFFF for k in keys))
+        return cls(ea_array(nodes), offsets, targets)
+
+    @classmethod
+    def from_dict(cls, graph):
+        """From the {ea: successor eas} form tarjan.py used to build."""
+        return cls.from_edges(((s, d) for s in graph for d in graph[s]), graph)
+
+    def __len__(self):
+        return len(self.eas)
+
+    @property
+    def edges(self):
+        return len(self.targets)
+
+    def node(self, ea):
+        i = bisect_left(self.eas, ea)
+        if i == len(self.eas) or self.eas[i] != ea:
+            raise KeyError(ea)
+        return i
+
+    def successors(self, i):
+        targets = self.targets
+        for k in range(self.offsets[i], self.offsets[i + 1]):
+            yield targets[k]
+
+    def predecessors(self, i):
+        return self.reverse().successors(i)
+
+    def reverse(self):
+        """The same nodes with every edge turned around, built on first use."""
+        if self._reverse is None:
+            n = len(self.eas)
+            offsets = array('I', [0]) * (n + 1)
+            for t in self.targets:
+                offsets[t + 1] += 1
+            for i in range(n):
+                offsets[i + 1] += offsets[i]
+            fill = array('I', offsets)
+            targets = array('I', [0]) * len(self.targets)
+            for i in range(n):
+                for k in range(self.offsets[i], self.offsets[i + 1]):
+                    t = self.targets[k]
+                    targets[fill[t]] = i
+                    fill[t] += 1
+            self._reverse = CSRGraph(self.eas, offsets, targets)
+            self._reverse._reverse = self
+        return self._reverse
+
+    def to_dict(self):
+        """{ea: set of successor eas} of the nodes with successors."""
+        out = {}
+        for i in range(len(self.eas)):
+            if self.offsets[i] != self.offsets[i + 1]:
+                out[self.eas[i]] = set(self.eas[t] for t in self.successors(i))
+        return out
+
+
+def strongly_connected_components_recursive(graph):
+    """
+    Tarjan's Algorithm (named for its discoverer, Robert Tarjan) is a graph theory algorithm
+    for finding the strongly connected components of a graph.
+
+    Based on: http://en.wikipedia.org/wiki/Tarjan%27s_strongly_connected_components_algorithm
+    """
+
+    index_counter = [0]
+    stack = []
+    lowlinks = {}
+    index = {}
+    result = []
+
+    def strongconnect(node):
+        # set the depth index for this node to the smallest unused index
+        index[node] = index_counter[0]
+        lowlinks[node] = index_counter[0]
+        index_counter[0] += 1
+        stack.append(node)
+
+        # Consider successors of `node`
+        try:
+            successors = graph[node]
+        except:
+            successors = []
+        for successor in successors:
+            if successor not in lowlinks:
+                # Successor has not yet been visited; recurse on it
+                strongconnect(successor)
+                lowlinks[node] = min(lowlinks[node],lowlinks[successor])
+            elif successor in stack:
+                # the successor is in the stack and hence in the current strongly connected component (SCC)
+                lowlinks[node] = min(lowlinks[node],index[successor])
+
+        # If `node` is a root node, pop the stack and generate an SCC
+        if lowlinks[node] == index[node]:
+            connected_component = []
+
+            while True:
+                successor = stack.pop()
+                connected_component.append(successor)
+                if successor == node: break
+            component = tuple(connected_component)
+            # storing the result
+            #result.append(component)
+            if len(component) > 1 or node in successors: result.append(component)
+
+    for node in graph:
+        if node not in lowlinks:
+            strongconnect(node)
+
+    return result
+
+
+def strongly_connected_components(graph):
+    """
+    Same components, in the same order, as strongly_connected_components_recursive,
+    without recursion: call chains of any depth fit.
+
+    Nodes get dense ids in visit order, which is also their Tarjan index, so only
+    the lowlinks need an array and the on-stack test is a bytearray lookup.
+    A CSRGraph is walked by its own ids, in address order.
+    """
+
+    if isinstance(graph, CSRGraph):
+        return _csr_components(graph)
+
+    def successors(node):
+        try:
+            return graph[node]
+        except:
+            return []
+
+    return [component for component in _components(graph, successors)
+            if len(component) > 1 or component[0] in successors(component[0])]
+
+
+def _components(roots, successors):
+    """
+    Every component reachable from roots, one node ones too, each as soon as
+    Tarjan completes it: a component comes before any that reaches it.
+    """
+
+    ids = {}
+    nodes = []
+    succs = []
+    lowlink = array('l')
+    onstack = bytearray()
+    stack = []
+
+    def visit(node):
+        v = len(nodes)
+        ids[node] = v
+        nodes.append(node)
+        succs.append(successors(node))
+        lowlink.append(v)
+        onstack.append(1)
+        stack.append(v)
+        return v
+
+    for root in roots:
+        if root in ids:
+            continue
+        work = [(visit(root), iter(succs[-1]))]
+        while work:
+            v, it = work[-1]
+            for successor in it:
+                w = ids.get(successor)
+                if w is None:
+                    # not visited yet, go down and come back to v later
+                    w = visit(successor)
+                    work.append((w, iter(succs[w])))
+                    break
+                if onstack[w] and w < lowlink[v]:
+                    lowlink[v] = w
+            else:
+                work.pop()
+                if lowlink[v] == v:
+                    # ids on the stack increase, so v's component is its tail
+                    i = bisect_left(stack, v)
+                    component = tuple(nodes[w] for w in reversed(stack[i:]))
+                    for w in stack[i:]:
+                        onstack[w] = 0
+                    del stack[i:]
+                    yield component
+                if work:
+                    u = work[-1][0]
+                    if lowlink[v] < lowlink[u]:
+                        lowlink[u] = lowlink[v]
+
+
+def _csr_components(graph):
+    eas, offsets, targets = graph.eas, graph.offsets, graph.targets
+    return [tuple(int(eas[w]) for w in part) for part in _csr_parts(graph)
+            if len(part) > 1 or part[0] in targets[offsets[part[0]]:offsets[part[0] + 1]]]
+
+
+def _csr_parts(graph):
+    """Every component of a CSRGraph as node ids, in Tarjan's completion order."""
+    n = len(graph)
+    offsets, targets = graph.offsets, graph.targets
+    index = array('l', [-1]) * n
+    lowlink = array('l', [0]) * n
+    onstack = bytearray(n)
+    stack = []
+    counter = 0
+    for root in range(n):
+        if index[root] >= 0:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        onstack[root] = 1
+        stack.append(root)
+        # (node, next edge to look at) of the nodes being visited
+        work = [root]
+        pos = [offsets[root]]
+        while work:
+            v = work[-1]
+            k = pos[-1]
+            end = offsets[v + 1]
+            while k < end:
+                w = targets[k]
+                k += 1
+                if index[w] < 0:
+                    break
+                if onstack[w] and index[w] < lowlink[v]:
+                    lowlink[v] = index[w]
+            else:
+                w = -1
+            if w >= 0 and index[w] < 0:
+                pos[-1] = k
+                index[w] = lowlink[w] = counter
+                counter += 1
+                onstack[w] = 1
+                stack.append(w)
+                work.append(w)
+                pos.append(offsets[w])
+                continue
+            work.pop()
+            pos.pop()
+            if lowlink[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    onstack[w] = 0
+                    component.append(w)
+                    if w == v:
+                        break
+                yield component
+            if work:
+                u = work[-1]
+                if lowlink[v] < lowlink[u]:
+                    lowlink[u] = lowlink[v]
+
+
+class IncrementalSCC(object):
+    """
+    Components of a graph edited an edge at a time, for a call graph that
+    follows the database instead of being rebuilt.
+
+    Every component has an order, increasing along the edges between
+    components.  An edge against the order is the only one that can close a
+    cycle: the components between its ends in the order are searched
+    (Pearce-Kelly), and those on a cycle are merged, the rest moved past each
+    other.  Removing an edge inside a component runs Tarjan over that
+    component's nodes only.  Orders are tuples, so the pieces of a split one
+    fit between its neighbours as order + (i,).
+
+    cluster(node) is a dict lookup.
+    """
+
+    def __init__(self, edges=(), nodes=()):
+        self.succ = {}
+        self.pred = {}
+        self.loops = set()
+        self.comp = {}          # node -> component id
+        self.members = {}       # component id -> set of nodes
+        self.csucc = {}         # component id -> {component id: edges to it}
+        self.cpred = {}
+        self.order = {}         # component id -> tuple
+        self._ids = 0
+        for node in nodes:
+            self.succ.setdefault(node, set())
+            self.pred.setdefault(node, set())
+        for u, v in edges:
+            self.succ.setdefault(u, set()).add(v)
+            self.pred.setdefault(u, set())
+            self.succ.setdefault(v, set())
+            self.pred.setdefault(v, set()).add(u)
+            if u == v:
+                self.loops.add(u)
+        components = list(_components(list(self.succ), self.succ.__getitem__))
+        # Tarjan completes sinks first
+        for i, component in enumerate(reversed(components)):
+            self._new(component, (i,))
+        self._top = len(components)
+        for u, vs in self.succ.items():
+            cu = self.comp[u]
+            for v in vs:
+                cv = self.comp[v]
+                if cu != cv:
+                    self._link(cu, cv, 1)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """From a CSRGraph or the {ea: successor eas} form."""
+        if isinstance(graph, CSRGraph):
+            eas = [int(ea) for ea in graph.eas]
+            edges = ((eas[i], eas[t]) for i in range(len(eas)) for t in graph.successors(i))
+            return cls(edges, eas)
+        return cls(((s, d) for s in graph for d in graph[s]), graph)
+
+    def __len__(self):
+        return len(self.succ)
+
+    def __contains__(self, node):
+        return node in self.succ
+
+    def _new(self, nodes, order):
+        cid = self._ids
+        self._ids += 1
+        self.members[cid] = set(nodes)
+        for node in nodes:
+            self.comp[node] = cid
+        self.csucc[cid] = {}
+        self.cpred[cid] = {}
+        self.order[cid] = order
+        return cid
+
+    def _drop(self, cid):
+        del self.members[cid], self.csucc[cid], self.cpred[cid], self.order[cid]
+
+    def _link(self, cu, cv, count):
+        """Count edges from component cu to cv, returns how many there were."""
+        n = self.csucc[cu].get(cv, 0)
+        if n + count:
+            self.csucc[cu][cv] = self.cpred[cv][cu] = n + count
+        else:
+            del self.csucc[cu][cv], self.cpred[cv][cu]
+        return n
+
+    def add_node(self, node):
+        if node in self.succ:
+            return
+        self.succ[node] = set()
+        self.pred[node] = set()
+        self._new((node,), (self._top,))
+        self._top += 1
+
+    def remove_node(self, node):
+        """Drop node and its edges."""
+        if node not in self.succ:
+            return
+        for v in list(self.succ[node]):
+            self.remove_edge(node, v)
+        for u in list(self.pred[node]):
+            self.remove_edge(u, node)
+        # no edges left, so a component of its own
+        self._drop(self.comp.pop(node))
+        del self.succ[node], self.pred[node]
+
+    def add_edge(self, u, v):
+        self.add_node(u)
+        self.add_node(v)
+        if v in self.succ[u]:
+            return
+        self.succ[u].add(v)
+        self.pred[v].add(u)
+        if u == v:
+            self.loops.add(u)
+            return
+        cu, cv = self.comp[u], self.comp[v]
+        if cu != cv and not self._link(cu, cv, 1) and self.order[cu] > self.order[cv]:
+            self._reorder(cu, cv)
+
+    def _reach(self, start, edges, lo, hi):
+        """Components reachable from start over edges, with lo <= order <= hi."""
+        order = self.order
+        seen = set([start])
+        work = [start]
+        while work:
+            for c in edges[work.pop()]:
+                if c not in seen and lo <= order[c] <= hi:
+                    seen.add(c)
+                    work.append(c)
+        return seen
+
+    def _reorder(self, cu, cv):
+        """New edge cu -> cv with cu after cv in the order."""
+        order = self.order
+        lo, hi = order[cv], order[cu]
+        forward = self._reach(cv, self.csucc, lo, hi)
+        backward = self._reach(cu, self.cpred, lo, hi)
+        slots = sorted(order[c] for c in forward | backward)
+        cycle = forward & backward
+        # whatever reaches cu goes first, then whatever cv reaches: each only
+        # moves towards its side, so edges leaving the region stay in order
+        before = sorted(backward - cycle, key=order.get)
+        after = sorted(forward - cycle, key=order.get)
+        for c, o in zip(before, slots):
+            order[c] = o
+        for c, o in zip(after, slots[len(slots) - len(after):]):
+            order[c] = o
+        if cycle:
+            order[self._merge(cycle)] = slots[len(before)]
+
+    def _merge(self, cids):
+        """One component out of cids, returns its id."""
+        into = max(cids, key=lambda c: len(self.members[c]))
+        out = {}
+        inc = {}
+        for c in cids:
+            for d, n in self.csucc[c].items():
+                if d not in cids:
+                    out[d] = out.get(d, 0) + n
+                    del self.cpred[d][c]
+            for d, n in self.cpred[c].items():
+                if d not in cids:
+                    inc[d] = inc.get(d, 0) + n
+                    del self.csucc[d][c]
+        for c in cids:
+            if c != into:
+                for node in self.members[c]:
+                    self.comp[node] = into
+                self.members[into] |= self.members[c]
+                self._drop(c)
+        self.csucc[into] = {}
+        self.cpred[into] = {}
+        for d, n in out.items():
+            self._link(into, d, n)
+        for d, n in inc.items():
+            self._link(d, into, n)
+        return into
+
+    def remove_edge(self, u, v):
+        if u not in self.succ or v not in self.succ[u]:
+            return
+        self.succ[u].remove(v)
+        self.pred[v].remove(u)
+        if u == v:
+            self.loops.discard(u)
+            return
+        cu, cv = self.comp[u], self.comp[v]
+        if cu != cv:
+            self._link(cu, cv, -1)
+        else:
+            self._split(cu)
+
+    def _split(self, cid):
+        """Recompute component cid after one of its edges went away."""
+        nodes = self.members[cid]
+        succ = self.succ
+        parts = list(_components(list(nodes), lambda node: [w for w in succ[node] if w in nodes]))
+        if len(parts) == 1:
+            return
+        order = self.order[cid]
+        for d in self.csucc[cid]:
+            del self.cpred[d][cid]
+        for d in self.cpred[cid]:
+            del self.csucc[d][cid]
+        self._drop(cid)
+        # still between the neighbours of the old component, sources first
+        for i, part in enumerate(reversed(parts)):
+            self._new(part, order + (i,))
+        comp = self.comp
+        for u in nodes:
+            cu = comp[u]
+            for v in succ[u]:
+                if comp[v] != cu:
+                    self._link(cu, comp[v], 1)
+            for v in self.pred[u]:
+                if v not in nodes:
+                    self._link(comp[v], cu, 1)
+
+    def component(self, node):
+        """The nodes of node's component, None for an unknown node."""
+        cid = self.comp.get(node)
+        return None if cid is None else self.members[cid]
+
+    def cluster(self, node):
+        """The recursion cluster node is in, None if it is not recursive."""
+        cid = self.comp.get(node)
+        if cid is None:
+            return None
+        members = self.members[cid]
+        if len(members) > 1 or node in self.loops:
+            return members
+        return None
+
+    def components(self):
+        """The recursive components, as strongly_connected_components lists them."""
+        return [tuple(members) for members in self.members.values()
+                if len(members) > 1 or next(iter(members)) in self.loops]
+
+
+class Condensation(object):
+    """
+    The DAG of all components of a graph, one node ones too.  Component ids
+    follow Tarjan's completion order, so callees come before their callers.
+    level[c] is 0 for a component that calls nothing outside itself, else one
+    more than its highest callee: no two components on a level depend on each
+    other.  loops holds the nodes that call themselves.
+    """
+
+    def __init__(self, components, callees, loops=()):
+        self.components = [tuple(c) for c in components]
+        self.callees = [list(c) for c in callees]
+        self.loops = set(loops)
+        self.comp = {}
+        for cid, members in enumerate(self.components):
+            for node in members:
+                self.comp[node] = cid
+        self.callers = [[] for c in self.components]
+        self.level = array('l', [0]) * len(self.components)
+        for cid, callees in enumerate(self.callees):
+            for callee in callees:
+                self.callers[callee].append(cid)
+                if self.level[callee] >= self.level[cid]:
+                    self.level[cid] = self.level[callee] + 1
+        self.levels = [[] for i in range(max(self.level) + 1 if self.components else 0)]
+        for cid, level in enumerate(self.level):
+            self.levels[level].append(cid)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """From a CSRGraph or the {ea: successor eas} form."""
+        if isinstance(graph, CSRGraph):
+            offsets, targets = graph.offsets, graph.targets
+            successors = lambda i: targets[offsets[i]:offsets[i + 1]]
+            eas = graph.eas.tolist() if hasattr(graph.eas, "tolist") else list(graph.eas)
+            name = eas.__getitem__
+            comp = [0] * len(graph)
+            parts = list(_csr_parts(graph))
+        else:
+            def successors(node):
+                try:
+                    return graph[node]
+                except:
+                    return []
+            name = lambda node: node
+            comp = {}
+            parts = list(_components(graph, successors))
+        for cid, members in enumerate(parts):
+            for node in members:
+                comp[node] = cid
+        callees = []
+        loops = []
+        for cid, members in enumerate(parts):
+            out = set()
+            for node in members:
+                for w in successors(node):
+                    out.add(comp[w])
+                    if w == node:
+                        loops.append(name(node))
+            out.discard(cid)
+            callees.append(sorted(out))
+        return cls([map(name, members) for members in parts], callees, loops)
+
+    def __len__(self):
+        return len(self.components)
+
+    def recursive(self, cid):
+        members = self.components[cid]
+        return len(members) > 1 or members[0] in self.loops
+
+
+class Scheduler(object):
+    """
+    Hands out the components of a Condensation bottom up: one is ready once
+    all its callees are done.
+    """
+
+    def __init__(self, dag):
+        self.dag = dag
+        self.waiting = array('l', (len(c) for c in dag.callees))
+        self.ready = deque(cid for cid, n in enumerate(self.waiting) if not n)
+        self.running = set()
+        self.finished = 0
+
+    def __len__(self):
+        """Components not done yet."""
+        return len(self.dag) - self.finished
+
+    def next(self):
+        """A ready component id, None if there is none until something is done."""
+        if not self.ready:
+            return None
+        cid = self.ready.popleft()
+        self.running.add(cid)
+        return cid
+
+    def done(self, cid):
+        self.running.remove(cid)
+        self.finished += 1
+        for caller in self.dag.callers[cid]:
+            self.waiting[caller] -= 1
+            if not self.waiting[caller]:
+                self.ready.append(caller)
+
+
+def _call(worker, cid, members):
+    try:
+        return cid, True, worker(members)
+    except Exception:
+        import traceback
+        return cid, False, traceback.format_exc()
+
+
+def run_bottom_up(dag, worker, processes=None):
+    """
+    worker(members) for every component of dag, in a pool of processes (one
+    per CPU by default), each only after all its callees returned.  worker
+    must be picklable, i.e. a module level function.  Yields (cid, result)
+    as components finish; a worker exception is raised here as RuntimeError,
+    as is a task the pool could not run (an unpicklable worker, say).
+    processes=1 runs in this process, e.g. inside IDA.
+    """
+    scheduler = Scheduler(dag)
+    if processes == 1:
+        while len(scheduler):
+            cid = scheduler.next()
+            result = worker(dag.components[cid])
+            scheduler.done(cid)
+            yield cid, result
+        return
+
+    import multiprocessing
+    try:
+        from queue import Queue, Empty
+    except ImportError:
+        from Queue import Queue, Empty
+    processes = processes or multiprocessing.cpu_count()
+    finished = Queue()
+    pending = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        while len(scheduler):
+            # keep the pool a little ahead, results come back via the callback
+            while len(scheduler.running) < 2 * processes:
+                cid = scheduler.next()
+                if cid is None:
+                    break
+                pending[cid] = pool.apply_async(_call, (worker, cid, dag.components[cid]), callback=finished.put)
+            try:
+                cid, ok, result = finished.get(timeout=0.1)
+            except Empty:
+                # a task that failed outside _call (say the worker does not
+                # pickle) never calls back, only its AsyncResult knows
+                for cid, r in pending.items():
+                    if r.ready() and not r.successful():
+                        try:
+                            r.get()
+                        except Exception as e:
+                            raise RuntimeError("component %d: %r" % (cid, e))
+                continue
+            del pending[cid]
+            if not ok:
+                raise RuntimeError("component %d: %s" % (cid, result))
+            scheduler.done(cid)
+            yield cid, result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def save_condensation(path, dag):
+    """Write dag to path as JSON, for jobs that run outside IDA."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"components": [list(c) for c in dag.components],
+                   "callees": dag.callees,
+                   "loops": sorted(dag.loops)}, f)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def load_condensation(path):
+    with open(path) as f:
+        data = json.load(f)
+    return Condensation(data["components"], data["callees"], data["loops"])
+
+
+GRAPH_MAGIC = b"SCCG"
+GRAPH_VERSION = 1
+# magic, version, digest of what the graph was built from, nodes, edges
+_graph_header = struct.Struct("<4sI20s4xQQ")
+
+
+def save_graph(path, graph, digest):
+    """Write graph to path, tagged with a 20 byte digest of its source."""
+    n = len(graph.eas)
+    m = len(graph.targets)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_graph_header.pack(GRAPH_MAGIC, GRAPH_VERSION, digest, n, m))
+        f.write(struct.pack("<%dQ" % n, *graph.eas))
+        f.write(struct.pack("<%dI" % (n + 1), *graph.offsets))
+        f.write(struct.pack("<%dI" % m, *graph.targets))
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+
+def _view(buf, offset, count, code):
+    size = struct.calcsize(code)
+    # not NumPy: the traversals index one element at a time, where its
+    # arrays are several times slower than a memoryview or an array
+    if hasattr(memoryview, "cast") and sys.byteorder == "little":
+        return memoryview(buf)[offset:offset + count * size].cast(code)
+    # py2: copy
+    data = buf[offset:offset + count * size]
+    if code == 'Q' and EA_TYPECODE is None:
+        return list(struct.unpack("<%dQ" % count, data))
+    a = array(EA_TYPECODE if code == 'Q' else code)
+    a.fromstring(data)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+
+def load_graph(path, digest=None):
+    """
+    The CSRGraph saved at path, its arrays mapped from the file.  None if there
+    is no such file, it is not a graph of this version, or it was saved with
+    another digest.
+    """
+    try:
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    if len(buf) < _graph_header.size:
+        return None
+    magic, version, stored, n, m = _graph_header.unpack_from(buf)
+    if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+        return None
+    if digest is not None and stored != digest:
+        return None
+    at = _graph_header.size
+    if len(buf) != at + 8 * n + 4 * (n + 1) + 4 * m:
+        return None
+    eas = _view(buf, at, n, 'Q')
+    offsets = _view(buf, at + 8 * n, n + 1, 'I')
+    targets = _view(buf, at + 12 * n + 4, m, 'I')
+    return CSRGraph(eas, offsets, targets, buf)
+
+
+def graph_digest(path):
+    """The digest a graph file was saved with, or None."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(_graph_header.size)
+        magic, version, digest, n, m = _graph_header.unpack(header)
+    except (IOError, OSError, struct.error):
+        return None
+    if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+        return None
+    return digest
+
+
+def _random_graph(rnd, n, degree):
+    graph = {}
+    for node in range(n):
+        if rnd.random() < 0.9:
+            # some successors are not keys of the graph, like callees without calls
+            graph[node] = set(rnd.randrange(n + n // 8) for i in range(rnd.randrange(degree + 1)))
+    return graph
+
+
+def _check_incremental(inc):
+    canon = lambda result: sorted(sorted(c) for c in result)
+    assert canon(inc.components()) == canon(strongly_connected_components(inc.succ))
+    links = {}
+    for u, vs in inc.succ.items():
+        for v in vs:
+            assert u in inc.pred[v]
+            cu, cv = inc.comp[u], inc.comp[v]
+            if cu != cv:
+                assert inc.order[cu] < inc.order[cv]
+                links[cu, cv] = links.get((cu, cv), 0) + 1
+    assert links == dict(((c, d), n) for c in inc.csucc for d, n in inc.csucc[c].items())
+    assert links == dict(((c, d), n) for d in inc.cpred for c, n in inc.cpred[d].items())
+    assert len(set(inc.order.values())) == len(inc.members) == len(set(inc.comp.values()))
+
+
+def _stand_in(members):
+    """Stand-in for a batch job: takes a moment, reports when it ran."""
+    import time
+    start = time.time()
+    time.sleep(0.0005 * (members[0] % 3))
+    return start, time.time()
+
+
+def _check_schedule(dag, processes):
+    ran = {}
+    for cid, (start, end) in run_bottom_up(dag, _stand_in, processes):
+        assert cid not in ran and all(callee in ran for callee in dag.callees[cid])
+        ran[cid] = start, end
+    assert len(ran) == len(dag)
+    for cid, callees in enumerate(dag.callees):
+        for callee in callees:
+            assert ran[callee][1] <= ran[cid][0], (callee, cid)
+
+
+def _self_check(rounds=300, seed=0):
+    import random
+    import sys
+    rnd = random.Random(seed)
+    for i in range(rounds):
+        graph = _random_graph(rnd, rnd.randrange(1, 200), rnd.choice([1, 2, 3, 5]))
+        expect = strongly_connected_components_recursive(graph)
+        got = strongly_connected_components(graph)
+        assert got == expect, (i, got, expect)
+    # a call chain deeper than the recursion limit, closed into one cycle
+    n = sys.getrecursionlimit() * 4
+    chain = dict((node, [node + 1]) for node in range(n))
+    chain[n] = [0]
+    got = strongly_connected_components(chain)
+    assert len(got) == 1 and len(got[0]) == n + 1
+    assert strongly_connected_components({1: [1], 2: [3]}) == [(1,)]
+    # the CSR form finds the same components, visited in address order
+    canon = lambda result: sorted(sorted(c) for c in result)
+    for i in range(rounds // 3):
+        graph = _random_graph(rnd, rnd.randrange(1, 200), rnd.choice([1, 2, 3, 5]))
+        csr = CSRGraph.from_dict(graph)
+        assert csr.to_dict() == dict((k, set(v)) for k, v in graph.items() if v)
+        assert canon(strongly_connected_components(csr)) == canon(strongly_connected_components(graph))
+        rev = csr.reverse()
+        assert rev.edges == csr.edges and rev.reverse() is csr
+        for v in range(len(csr)):
+            assert all(v in csr.successors(u) for u in csr.predecessors(v))
+        for ea in graph:
+            assert csr.eas[csr.node(ea)] == ea
+    csr = CSRGraph.from_dict(chain)
+    assert canon(strongly_connected_components(csr)) == [list(range(n + 1))]
+    # edits kept up incrementally match a recompute from scratch
+    for i in range(rounds // 10):
+        size = rnd.randrange(2, 60)
+        graph = _random_graph(rnd, size, rnd.choice([1, 2]))
+        inc = IncrementalSCC.from_graph(CSRGraph.from_dict(graph) if i & 1 else graph)
+        for j in range(200):
+            u, v = rnd.randrange(size + 5), rnd.randrange(size + 5)
+            x = rnd.random()
+            if x < 0.6:
+                inc.add_edge(u, v)
+            elif x < 0.95:
+                inc.remove_edge(u, rnd.choice(sorted(inc.succ.get(u, ())) or [v]))
+            else:
+                inc.remove_node(u)
+            _check_incremental(inc)
+    inc = IncrementalSCC(((k, k + 1) for k in range(1000)), [5000])
+    inc.add_edge(1000, 0)
+    assert len(inc.cluster(500)) == 1001 and inc.cluster(5000) is None
+    inc.remove_edge(400, 401)
+    assert inc.cluster(500) is None and inc.cluster(-1) is None
+    inc.add_edge(5000, 5000)
+    assert inc.cluster(5000) == set([5000])
+    # the condensation is a DAG levelled bottom up, and the scheduler keeps to it
+    for i in range(rounds // 10):
+        graph = _random_graph(rnd, rnd.randrange(1, 200), rnd.choice([1, 2]))
+        dag = Condensation.from_graph(graph if i & 1 else CSRGraph.from_dict(graph))
+        assert canon(dag.components[c] for c in range(len(dag)) if dag.recursive(c)) == \
+            canon(strongly_connected_components(graph))
+        for cid, callees in enumerate(dag.callees):
+            assert all(callee < cid and dag.level[callee] < dag.level[cid] for callee in callees)
+            assert dag.level[cid] == 0 or dag.level[cid] - 1 in [dag.level[c] for c in callees]
+        assert sorted(sum(dag.levels, [])) == list(range(len(dag)))
+        _check_schedule(dag, 1)
+    _check_schedule(Condensation.from_graph(_random_graph(rnd, 300, 1)), 4)
+    # a worker the pool cannot pickle fails the run instead of hanging it
+    try:
+        list(run_bottom_up(Condensation.from_graph({1: [2], 2: [1]}), lambda members: 0, 2))
+    except RuntimeError:
+        pass
+    else:
+        assert False, "lambda worker ran in a pool"
+    # save and map back
+    import tempfile
+    fd, path = tempfile.mkstemp(".scc")
+    os.close(fd)
+    try:
+        graph = _random_graph(rnd, 500, 3)
+        graph[0xFFFFFFF007004000] = [0xFFFFFFF007004000, 1]
+        csr = CSRGraph.from_dict(graph)
+        save_graph(path, csr, b"d" * 20)
+        assert graph_digest(path) == b"d" * 20
+        assert load_graph(path, b"x" * 20) is None
+        loaded = load_graph(path, b"d" * 20)
+        assert loaded.to_dict() == csr.to_dict()
+        assert strongly_connected_components(loaded) == strongly_connected_components(csr)
+        assert loaded.node(0xFFFFFFF007004000) == len(loaded) - 1
+        assert loaded.reverse().to_dict() == csr.reverse().to_dict()
+        dag = Condensation.from_graph(csr)
+        save_condensation(path, dag)
+        loaded = load_condensation(path)
+        assert loaded.components == dag.components and loaded.levels == dag.levels
+        assert loaded.loops == dag.loops == set([0xFFFFFFF007004000]) | set(v for v in graph if v in graph[v])
+        loaded = None
+        with open(path, "r+b") as f:
+            f.truncate(100)
+        assert load_graph(path) is None
+    finally:
+        os.remove(path)
+    print("scc: %d random graphs, a %d deep chain, %d edit runs and %d schedules OK" % (rounds, n + 1, rounds // 10, rounds // 10 + 1))
+
+
+if __name__ == "__main__":
+    _self_check()
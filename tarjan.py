@@ -15,89 +15,478 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import csv
+import hashlib
+import json
+import os
+import struct
+import sys
+from timeit import default_timer as clock
+
 import idautils
 import idc
 import idaapi
 
-
-def strongly_connected_components(graph):
-    """
-    Tarjan's Algorithm (named for its discoverer, Robert Tarjan) is a graph theory algorithm
-    for finding the strongly connected components of a graph.
-
-    Based on: http://en.wikipedia.org/wiki/Tarjan%27s_strongly_connected_components_algorithm
-    """
-
-    index_counter = [0]
-    stack = []
-    lowlinks = {}
-    index = {}
-    result = []
-
-    def strongconnect(node):
-        # set the depth index for this node to the smallest unused index
-        index[node] = index_counter[0]
-        lowlinks[node] = index_counter[0]
-        index_counter[0] += 1
-        stack.append(node)
-
-        # Consider successors of `node`
-        try:
-            successors = graph[node]
-        except:
-            successors = []
-        for successor in successors:
-            if successor not in lowlinks:
-                # Successor has not yet been visited; recurse on it
-                strongconnect(successor)
-                lowlinks[node] = min(lowlinks[node],lowlinks[successor])
-            elif successor in stack:
-                # the successor is in the stack and hence in the current strongly connected component (SCC)
-                lowlinks[node] = min(lowlinks[node],index[successor])
-
-        # If `node` is a root node, pop the stack and generate an SCC
-        if lowlinks[node] == index[node]:
-            connected_component = []
-
-            while True:
-                successor = stack.pop()
-                connected_component.append(successor)
-                if successor == node: break
-            component = tuple(connected_component)
-            # storing the result
-            #result.append(component)
-            if len(component) > 1 or node in successors: result.append(component)
-
-    for node in graph:
-        if node not in lowlinks:
-            strongconnect(node)
-
-    return result
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from scc import CSRGraph, Condensation, IncrementalSCC, strongly_connected_components, load_graph, save_graph, \
+    save_condensation
 
 
 def get_succ(func_start):
     succ = set()
     for h in idautils.FuncItems(func_start):
         for r in idautils.XrefsFrom(h, 0):
-            if r.type == fl_CF or r.type == fl_CN:
+            if r.type == idaapi.fl_CF or r.type == idaapi.fl_CN:
                 #print hex(h), "-->", hex(r.to)
                 succ.add(r.to)
     return succ
 
 
-graph = {}
+def build_graph_per_function():
+    graph = {}
+    for f in idautils.Functions():
+        sux = get_succ(f)
+        if sux:
+            graph[f] = sux
+    return graph
+
+
+def function_ranges():
+    """Sorted (start, end, function) of every chunk of every function."""
+    ranges = []
+    for f in idautils.Functions():
+        for start, end in idautils.Chunks(f):
+            ranges.append((start, end, f))
+    ranges.sort()
+    return ranges
+
+
+def call_edges():
+    """
+    (caller, callee) of every call reference, from one walk over the function
+    chunks in address order.  Like get_succ, it finds the functions wherever
+    they are, code segments or not.
+    """
+    xb = idaapi.xrefblk_t()
+    for start, end, f in function_ranges():
+        for h in idautils.Heads(start, end):
+            ok = xb.first_from(h, idaapi.XREF_FAR)
+            while ok:
+                if xb.type == idaapi.fl_CF or xb.type == idaapi.fl_CN:
+                    yield f, xb.to
+                ok = xb.next_from()
+
+
+def build_graph():
+    """Same graph as build_graph_per_function, as a CSRGraph."""
+    return CSRGraph.from_edges(call_edges())
+
+
+def graph_path():
+    """Where the call graph of this database is kept, next to the IDB."""
+    return os.path.splitext(idc.GetIdbPath())[0] + ".callgraph"
+
+
+def dag_path():
+    """Where the condensation DAG is written for bottom-up batch jobs."""
+    return os.path.splitext(idc.GetIdbPath())[0] + ".sccdag.json"
+
+
+def code_digest(edges=None):
+    """
+    sha1 of the graph's inputs: the code segments, the function chunks and
+    every call xref from them.  Walking the calls costs as much as the build,
+    so (caller, callee) of each one goes to edges when given, for building
+    the graph from the same walk if the file is stale.
+    """
+    h = hashlib.sha1()
+    for n in range(idaapi.get_segm_qty()):
+        seg = idaapi.getnseg(n)
+        if seg.type != idaapi.SEG_CODE:
+            continue
+        h.update(struct.pack("<QQ", seg.startEA, seg.endEA))
+        ea = seg.startEA
+        while ea < seg.endEA:
+            size = min(seg.endEA - ea, 1 << 20)
+            data = idaapi.get_many_bytes(ea, size)
+            # not all loaded, e.g. a __bss in a code segment
+            h.update(data if data is not None else struct.pack("<Q", size))
+            ea += size
+    ranges = function_ranges()
+    for start, end, f in ranges:
+        h.update(struct.pack("<QQQ", start, end, f))
+    xb = idaapi.xrefblk_t()
+    for start, end, f in ranges:
+        calls = []
+        for item in idautils.Heads(start, end):
+            ok = xb.first_from(item, idaapi.XREF_FAR)
+            while ok:
+                if xb.type == idaapi.fl_CF or xb.type == idaapi.fl_CN:
+                    calls.append(item)
+                    calls.append(xb.to)
+                    if edges is not None:
+                        edges.append((f, xb.to))
+                ok = xb.next_from()
+        # a chunk with no calls still counts, one added there changes the hash
+        h.update(struct.pack("<I%dQ" % len(calls), len(calls), *calls))
+    return h.digest()
+
+
+def load_call_graph(rebuild=False):
+    """
+    The call graph as a CSRGraph, mapped from graph_path() when the file is
+    there and matches the database, else built and saved there.  rebuild
+    skips the file.  Returns (graph, True if it was loaded).
+    """
+    path = graph_path()
+    edges = []
+    digest = code_digest(edges)
+    graph = None if rebuild else load_graph(path, digest)
+    if graph is not None:
+        return graph, True
+    graph = CSRGraph.from_edges(edges)
+    try:
+        save_graph(path, graph, digest)
+    except (IOError, OSError) as e:
+        print "+graph: cannot save %s: %s" % (path, e)
+    return graph, False
+
+
+def func_start(pfn):
+    return pfn.start_ea if hasattr(pfn, "start_ea") else pfn.startEA
+
+
+def is_call(xtype):
+    xtype &= idaapi.XREF_MASK
+    return xtype == idaapi.fl_CF or xtype == idaapi.fl_CN
+
+
+class Resident(object):
+    """
+    The call graph and its components, kept in step with the database by the
+    hooks below, so a change costs an edge update instead of a rerun.
+    """
+
+    def __init__(self, graph):
+        self.scc = IncrementalSCC.from_graph(graph)
+        # caller -> {callee: addresses of its calls}, see sites()
+        self.callsites = {}
+
+    def calls_from(self, f):
+        """(address, callee) of every call in function f."""
+        xb = idaapi.xrefblk_t()
+        for h in idautils.FuncItems(f):
+            ok = xb.first_from(h, idaapi.XREF_FAR)
+            while ok:
+                if is_call(xb.type):
+                    yield h, xb.to
+                ok = xb.next_from()
+
+    def sites(self, caller):
+        """
+        The call sites of caller by callee, read from the database the first
+        time they are needed and kept up by add_call and del_call after that.
+        """
+        sites = self.callsites.get(caller)
+        if sites is None:
+            sites = self.callsites[caller] = {}
+            for h, to in self.calls_from(caller):
+                sites.setdefault(to, set()).add(h)
+        return sites
+
+    def add_call(self, frm, to):
+        pfn = idaapi.get_func(frm)
+        if pfn:
+            caller = func_start(pfn)
+            # not read yet, the database will have this one when it is
+            if caller in self.callsites:
+                self.callsites[caller].setdefault(to, set()).add(frm)
+            self.scc.add_edge(caller, to)
+
+    def del_call(self, frm, to):
+        """The call at frm is going away, the edge goes with the last call from its function to to."""
+        pfn = idaapi.get_func(frm)
+        if not pfn:
+            return
+        caller = func_start(pfn)
+        sites = self.sites(caller)
+        calls = sites.get(to, set())
+        calls.discard(frm)
+        if not calls:
+            sites.pop(to, None)
+            self.scc.remove_edge(caller, to)
+
+    def refresh(self, pfn):
+        """Rescan a function that was added or got or lost a chunk."""
+        caller = func_start(pfn)
+        self.callsites.pop(caller, None)
+        calls = self.sites(caller)
+        for to in self.scc.succ.get(caller, set()) - set(calls):
+            self.scc.remove_edge(caller, to)
+        self.scc.add_node(caller)
+        for to in calls:
+            self.scc.add_edge(caller, to)
+
+    def remove(self, pfn):
+        caller = func_start(pfn)
+        self.callsites.pop(caller, None)
+        for to in list(self.scc.succ.get(caller, ())):
+            self.scc.remove_edge(caller, to)
+        if not self.scc.pred.get(caller):
+            self.scc.remove_node(caller)
+
+    def cluster(self, ea):
+        pfn = idaapi.get_func(ea)
+        return self.scc.cluster(func_start(pfn) if pfn else ea)
+
+
+# IDA 6 sends function and xref changes to the IDP hooks, IDA 7 splits them
+# between ev_* IDP events and IDB events; each class answers to both names
+
+class ResidentIDPHooks(idaapi.IDP_Hooks):
+    def __init__(self, resident):
+        idaapi.IDP_Hooks.__init__(self)
+        self.resident = resident
+
+    def add_cref(self, frm, to, type):
+        if is_call(type):
+            self.resident.add_call(frm, to)
+        return 0
+
+    def del_cref(self, frm, to, expand):
+        self.resident.del_call(frm, to)
+        return 0
+
+    def add_func(self, pfn):
+        self.resident.refresh(pfn)
+        return 0
+
+    def del_func(self, pfn):
+        self.resident.remove(pfn)
+        return 0
+
+    def ev_add_cref(self, frm, to, type):
+        return self.add_cref(frm, to, type)
+
+    def ev_del_cref(self, frm, to, expand):
+        return self.del_cref(frm, to, expand)
+
+
+class ResidentIDBHooks(idaapi.IDB_Hooks):
+    def __init__(self, resident):
+        idaapi.IDB_Hooks.__init__(self)
+        self.resident = resident
+
+    def func_added(self, pfn):
+        self.resident.refresh(pfn)
+        return 0
+
+    def deleting_func(self, pfn):
+        self.resident.remove(pfn)
+        return 0
+
+    def func_tail_appended(self, pfn, tail):
+        self.resident.refresh(pfn)
+        return 0
+
+    def func_tail_removed(self, pfn, tail_ea):
+        self.resident.refresh(pfn)
+        return 0
+
+
+resident = None
+resident_hooks = []
+
+
+def start_resident(graph=None):
+    """
+    Keep the call graph and its components in memory and follow the database.
+    From the console: tarjan.start_resident(), then tarjan.cluster(here()).
+    """
+    global resident
+    stop_resident()
+    if graph is None:
+        graph = load_call_graph(REBUILD_GRAPH)[0]
+    t = clock()
+    resident = Resident(graph)
+    resident_hooks.extend([ResidentIDPHooks(resident), ResidentIDBHooks(resident)])
+    for h in resident_hooks:
+        h.hook()
+    print "+resident: %d functions, %d components in %.2fs" % (len(resident.scc), len(resident.scc.members), clock() - t)
+
+
+def stop_resident():
+    global resident
+    for h in resident_hooks:
+        h.unhook()
+    del resident_hooks[:]
+    resident = None
+
+
+def cluster(ea):
+    """
+    Start addresses of the functions in the recursion cluster of the function
+    at ea, None if it is not recursive.  The set is live, do not change it.
+    """
+    if resident is None:
+        start_resident()
+    return resident.cluster(ea)
+
+
+def resolve_names(components):
+    """
+    {ea: name} for every function in components, from one pass over the name
+    list instead of a name lookup per function.  Functions without a name get
+    the sub_ one IDA shows.
+    """
+    names = {}
+    for r in components:
+        for f in r:
+            names[f] = None
+    for ea, name in idautils.Names():
+        if ea in names:
+            names[ea] = name
+    for ea, name in names.items():
+        if name is None:
+            names[ea] = "sub_%X" % ea
+    return names
+
+
+def by_size(components):
+    """Largest first, ties in the order Tarjan found them."""
+    return sorted(components, key=len, reverse=True)
+
+
+def output_path(fmt):
+    return os.path.splitext(idc.GetIdbPath())[0] + ".scc." + fmt
+
+
+def write_jsonl(path, rows, names):
+    """One JSON object per component and line."""
+    with open(path, "w") as f:
+        for i, r in enumerate(rows):
+            f.write(json.dumps({"cluster": i, "size": len(r),
+                                "functions": [{"ea": ea, "name": names[ea]} for ea in r]}))
+            f.write("\n")
+
+
+def write_csv(path, rows, names):
+    """One row per function: cluster, size, ea, name."""
+    with open(path, "wb") as f:
+        w = csv.writer(f)
+        w.writerow(["cluster", "size", "ea", "name"])
+        for i, r in enumerate(rows):
+            for ea in r:
+                w.writerow([i, len(r), "0x%X" % ea, names[ea]])
+
+
+WRITERS = {"jsonl": write_jsonl, "csv": write_csv}
+
+_Choose = idaapi.Choose2 if hasattr(idaapi, "Choose2") else idaapi.Choose
+
+
+class ClusterChooser(_Choose):
+    """One line per component, formatted only when IDA shows it."""
+
+    def __init__(self, title, rows, names):
+        _Choose.__init__(self, title, [
+            ["Cluster", 6 | _Choose.CHCOL_DEC],
+            ["Size", 6 | _Choose.CHCOL_DEC],
+            ["Address", 16 | _Choose.CHCOL_HEX],
+            ["Functions", 60]])
+        self.rows = rows
+        self.names = names
+
+    def OnGetSize(self):
+        return len(self.rows)
+
+    def OnGetLine(self, n):
+        r = self.rows[n]
+        text = " ".join(self.names[ea] for ea in r[:16])
+        if len(r) > 16:
+            text += " ..."
+        return ["%d" % n, "%d" % len(r), "%X" % min(r), text]
+
+    def OnSelectLine(self, n):
+        idaapi.jumpto(min(self.rows[n]))
+        if not hasattr(idaapi, "Choose2"):
+            return (idaapi.Choose.NOTHING_CHANGED,)
+
+
+def show_clusters(components, names=None, title="Recursion clusters"):
+    rows = by_size(components)
+    c = ClusterChooser(title, rows, names or resolve_names(rows))
+    c.Show()
+    return c
+
+
+# build the call graph even if the saved one matches, e.g. after adding calls by hand
+REBUILD_GRAPH = False
+# also run the get_succ builder, to time it and check both agree
+COMPARE_BUILDERS = False
+# write the condensation DAG to dag_path(), see scc.run_bottom_up
+EMIT_DAG = True
+# "jsonl" or "csv": write the components to output_path(), largest first
+OUTPUT_FORMAT = "jsonl"
+# browse the components in a chooser
+SHOW_CHOOSER = True
+# the old listing, one line per component in the output window
+PRINT_COMPONENTS = False
+# stay loaded after the listing, following the database for cluster(ea)
+RESIDENT = False
+
+
+def main():
+    print "+graph"
+    t = clock()
+    graph, loaded = load_call_graph(REBUILD_GRAPH)
+    print "+graph: %d nodes, %d edges %s in %.2fs" % (len(graph), graph.edges, "loaded" if loaded else "built", clock() - t)
+    if COMPARE_BUILDERS:
+        t = clock()
+        old = build_graph_per_function()
+        print "+graph: get_succ builder took %.2fs, %s" % (clock() - t, "same graph" if old == graph.to_dict() else "GRAPHS DIFFER")
+
+    print "+tarjan"
+    t = clock()
+    result = strongly_connected_components(graph)
+    print "+tarjan: %d components in %.2fs" % (len(result), clock() - t)
+
+    if EMIT_DAG:
+        t = clock()
+        dag = Condensation.from_graph(graph)
+        widest = max(len(l) for l in dag.levels) if dag.levels else 0
+        print "+dag: %d components on %d levels, widest %d, in %.2fs" % (len(dag), len(dag.levels), widest, clock() - t)
+        path = dag_path()
+        try:
+            save_condensation(path, dag)
+            print "+dag: written to %s" % path
+        except (IOError, OSError) as e:
+            print "+dag: cannot save %s: %s" % (path, e)
+
+    t = clock()
+    rows = by_size(result)
+    names = resolve_names(rows)
+    print "+names: %d in %.2fs" % (len(names), clock() - t)
+    if OUTPUT_FORMAT:
+        t = clock()
+        path = output_path(OUTPUT_FORMAT)
+        try:
+            WRITERS[OUTPUT_FORMAT](path, rows, names)
+            print "+output: %s in %.2fs" % (path, clock() - t)
+        except (IOError, OSError) as e:
+            print "+output: cannot write %s: %s" % (path, e)
+    if SHOW_CHOOSER:
+        show_clusters(rows, names)
+
+    print "+done"
+    if PRINT_COMPONENTS:
+        for r in rows:
+            print " ".join(names[f] for f in r)
+            print "-"
 
-print "+graph"
-for f in idautils.Functions():
-    sux = get_succ(f)
-    if sux:
-        graph[f] = sux
+    if RESIDENT:
+        start_resident(graph)
 
-print "+tarjan"
-result = strongly_connected_components(graph)
 
-print "+done"
-for r in result:
-    for f in r:
-        print(Name(f)),
-    print "-"
+if __name__ == "__main__":
+    main()